@@ -33,7 +33,7 @@
 # ---------------------------------------------------------------------------------
 # imports
 import os, re
-from rules.utils.get_file import get_signal_batch, get_alignment_batch
+from rules.utils.get_file import get_signal_batch, get_signal_cache, get_alignment_batch
 
 
 rule methylation_bumblebee:
@@ -53,11 +53,12 @@ rule methylation_bumblebee:
         time_min = lambda wildcards, input, threads, attempt: int((1920 / threads) * attempt)   # 120 min / 16 threads
     params:
         index = lambda wildcards : '--index ' + os.path.join(config['storage_data_raw'], wildcards.runname, 'reads.fofn') if get_signal_batch(wildcards, config).endswith('.txt') else '',
+        cache = lambda wildcards : get_signal_cache(config),
         device = lambda wildcards: '--device ' + str(config['plugin/bumblebee/device']) if 'plugin/bumblebee/device' in config else ''
     shell:
         """
         source {config[plugin/bumblebee/env]}
         mkdir -p raw
-        {config[bin][python]} {config[sbin][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} --output_format bulk
+        {config[bin][python]} {config[sbin][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} {params.cache} --output_format bulk
         bumblebee modcall {config[plugin/bumblebee/model]} raw/ {input.bam} {input.reference} {params.device} --nproc {config[plugin/bumblebee/nproc]} --threads {config[plugin/bumblebee/threads]} | perl -anle 'print join("\t", @F[0..5], $F[7]-$F[6])' | sort -k1,1 -k2,2n | gzip > {output}
         """
@@ -32,12 +32,12 @@
 # Written by Pay Giesselmann
 # ---------------------------------------------------------------------------------
 # imports
-import os, glob
+import os, re, glob, shlex
 from rules.utils.get_file import get_batch_ids_raw, get_sequence_batch
 
 # local rules
 localrules: graphmap_index, ngmlr_index, aligner_merge_batches, aligner_merge_tag, aligner_1D2
-localrules: aligner_merge_batches_names, aligner_merge_tag_names
+localrules: aligner_merge_batches_names, aligner_merge_tag_names, aligner_stats
 #ruleorder: aligner_sam2bam > aligner_merge_batches_run
 
 # get batches
@@ -60,28 +60,150 @@ def get_batches_aligner2(wildcards, config):
                         reference=wildcards.reference)
     return r
 
+# batch statistics written with the BAM, existing BAMs without statistics are read again instead of realigned
+def get_batches_aligner_stats(wildcards, config):
+    stats = []
+    for bam in get_batches_aligner(wildcards, config):
+        sidecar = bam[:-len('.bam')] + '.stats.hdf5'
+        stats.append(bam if os.path.isfile(bam) and not os.path.isfile(sidecar) else sidecar)
+    return stats
+
+# consecutive sequence batches of a run aligned in one job
+def get_super_batch_size(config):
+    return int(config.get('alignment_super_batch') or 1)
+
+# super batches and batch to group lookup per run and tag, sorted once per workflow
+__super_batches__ = {}
+
+def __get_super_batches__(wildcards, config):
+    n = get_super_batch_size(config)
+    key = (wildcards.runname, wildcards.tag, n)
+    if key not in __super_batches__:
+        batches = get_batch_ids_raw(wildcards.runname, config=config, tag=wildcards.tag, checkpoints=checkpoints)
+        batches = sorted(batches, key=lambda batch : [int(t) if t.isdigit() else t for t in re.split(r'([0-9]+)', batch)])
+        groups = [batches[i:i+n] for i in range(0, len(batches), n)]
+        __super_batches__[key] = (groups, {batch:i for i, group in enumerate(groups) for batch in group})
+    return __super_batches__[key]
+
+def get_super_batches(wildcards, config):
+    return __get_super_batches__(wildcards, config)[0]
+
+def get_super_batch_group(wildcards, config):
+    return __get_super_batches__(wildcards, config)[1][wildcards.batch]
+
+def get_super_batch_sequences(wildcards, config):
+    return expand("sequences/{sequence_workflow}/batches/{tag}/{runname}/{batch}.fastq.gz",
+                        sequence_workflow=wildcards.sequence_workflow,
+                        tag=wildcards.tag,
+                        runname=wildcards.runname,
+                        batch=get_super_batches(wildcards, config)[int(wildcards.group)])
+
+def get_super_batch_reference(wildcards, config):
+    genome = config['references'][wildcards.reference]['genome']
+    if wildcards.aligner == 'minimap2':
+        return [get_minimap2_index(wildcards, config)]
+    elif wildcards.aligner == 'graphmap2':
+        return [genome, genome + '.gmidx']
+    else:
+        return [genome, genome + '.ngm', genome + '.fai']
+
+def get_super_batch_aligner(wildcards, input, config):
+    if wildcards.aligner == 'minimap2':
+        return '{bin} -t $THREADS {flags} {ref} sequences.fastq.gz'.format(bin=config['bin_singularity']['minimap2'], flags=config['alignment_minimap2_flags'], ref=input.reference[0])
+    elif wildcards.aligner == 'graphmap2':
+        return '{bin} align -r {ref} -d sequences.fastq.gz -t $THREADS {flags}'.format(bin=config['bin_singularity']['graphmap2'], flags=config['alignment_graphmap2_flags'], ref=input.reference[0])
+    else:
+        return 'cat sequences.fastq.gz | {bin} -r {ref} -t $THREADS {flags}'.format(bin=config['bin_singularity']['ngmlr'], flags=config['alignment_ngmlr_flags'], ref=input.reference[0])
+
+# minimap2 index of reference with preset and indexing options in alignment flags
+# options are stored in the index and used at mapping time, each setting gets its own index
+def get_minimap2_index_options(config):
+    # short options of minimap2 taking an argument
+    arg_opts = 'wkKtrfvgGIdTsxpMnzABOEmNuRFCoeUjbJ'
+    options = []
+    tokens = shlex.split(config.get('alignment_minimap2_flags') or '')
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if not token.startswith('-') or token.startswith('--'):
+            continue
+        for j, opt in enumerate(token[1:]):
+            if opt in arg_opts:
+                value = token[j+2:]
+                if not value and i < len(tokens):
+                    value = tokens[i]
+                    i += 1
+                if opt in 'xkwI':
+                    options.append((opt, value))
+                break
+            elif opt == 'H':
+                options.append((opt, ''))
+    return options
+
+def get_minimap2_preset(config):
+    options = get_minimap2_index_options(config)
+    presets = [value for opt, value in options if opt == 'x']
+    key = '_'.join([opt + value.replace('.', 'p') for opt, value in options if opt != 'x'])
+    return '_'.join(([presets[-1]] if presets else ['default']) + ([key] if key else []))
+
+def get_minimap2_index_flags(config):
+    return ' '.join(['-' + opt + (' ' + value if value else '') for opt, value in get_minimap2_index_options(config)])
+
+def get_minimap2_index(wildcards, config):
+    return config['references'][wildcards.reference]['genome'] + '.' + get_minimap2_preset(config) + '.mmi'
+
+# minimap2 memory in MB from index size, estimated from reference before index is built
+def get_minimap2_index_mb(wildcards, config):
+    index = get_minimap2_index(wildcards, config)
+    if os.path.isfile(index):
+        return os.path.getsize(index) / 1e6
+    genome = config['references'][wildcards.reference]['genome']
+    return 2.5 * os.path.getsize(genome) / 1e6 if os.path.isfile(genome) else config['memory']['minimap2'][0]
+
 
 # minimap alignment
 rule minimap2:
     input:
         sequence = lambda wildcards: get_sequence_batch(wildcards, config),
-        reference = lambda wildcards: config['references'][wildcards.reference]['genome']
+        index = lambda wildcards: get_minimap2_index(wildcards, config)
     output:
         pipe("alignments/minimap2/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference}.sam")
     threads: config['threads_alignment']
     group: "minimap2"
     resources:
         threads = lambda wildcards, threads: threads,
-        mem_mb = lambda wildcards, threads, attempt: int((1.0 + (0.2 * (attempt - 1))) * (config['memory']['minimap2'][0] + config['memory']['minimap2'][1] * threads)),
+        mem_mb = lambda wildcards, threads, attempt: int((1.0 + (0.2 * (attempt - 1))) * (1000 + 1.1 * get_minimap2_index_mb(wildcards, config) + config['memory']['minimap2'][1] * threads)),
         time_min = lambda wildcards, threads, attempt: int((960 / threads) * attempt * config['runtime']['minimap2'])   # 60 min / 16 threads
     singularity:
         config['singularity_images']['alignment']
     shell:
         """
-        {config[bin_singularity][minimap2]} -t {threads} {config[alignment_minimap2_flags]} {input.reference} {input.sequence} 1>> {output} 2> >(tee {output}.log >&2)
+        {config[bin_singularity][minimap2]} -t {threads} {config[alignment_minimap2_flags]} {input.index} {input.sequence} 1>> {output} 2> >(tee {output}.log >&2)
         if [ $(grep 'ERROR' {output}.log | wc -l) -gt 0 ]; then exit 1; else rm {output}.log; fi
         """
 
+# minimap2 index
+rule minimap2_index:
+    input:
+        fasta = "{reference}.{ext}"
+    output:
+        index = "{reference}.{ext, (fa|fasta)}.{preset, [^.\/]*}.mmi"
+    threads: config['threads_alignment']
+    resources:
+        threads = lambda wildcards, threads: threads,
+        mem_mb = lambda wildcards, attempt: int((1.0 + (0.2 * (attempt - 1))) * max(config['memory']['minimap2'][0], 4.0 * os.path.getsize(wildcards.reference + '.' + wildcards.ext) / 1e6)),
+        time_min = lambda wildcards, attempt: int(60 * attempt * config['runtime']['minimap2'])
+    params:
+        flags = lambda wildcards: get_minimap2_index_flags(config)
+    singularity:
+        config['singularity_images']['alignment']
+    shell:
+        """
+        {config[bin_singularity][minimap2]} -t {threads} {params.flags} -d {output.index}.tmp {input.fasta}
+        mv {output.index}.tmp {output.index}
+        """
+
 # graphmap2 alignment
 rule graphmap2:
     input:
@@ -178,9 +300,10 @@ rule aligner_sam2bam:
         sam = "alignments/{aligner}/{sequence_workflow}/batches/{tag}/{runname}/{batch}.{reference}.sam"
     output:
         bam = "alignments/{aligner, [^.\/]*}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference, [^.]*}.bam",
-        bai = "alignments/{aligner, [^.\/]*}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference, [^.]*}.bam.bai"
+        bai = "alignments/{aligner, [^.\/]*}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference, [^.]*}.bam.bai",
+        stats = "alignments/{aligner, [^.\/]*}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference, [^.]*}.stats.hdf5"
     shadow: "minimal"
-    threads: 1
+    threads: config.get('threads_samtools') or 1
     resources:
         threads = lambda wildcards, threads: threads,
         mem_mb = lambda wildcards, attempt: int((1.0 + (0.2 * (attempt - 1))) * 5000)
@@ -188,10 +311,70 @@ rule aligner_sam2bam:
         config['singularity_images']['alignment']
     shell:
         """
-        cat {input.sam} | perl -anle 'BEGIN{{$header=1}}; if($header == 1){{ if($_ =~ /^@/) {{print $_}} else {{$header=0; print "\@RG\tID:{wildcards.batch}"}}}} else {{print $_}}' | perl -anle 'if($_ =~ /^@/){{print $_}}else{{print join("\t", @F, "RG:Z:{wildcards.batch}")}}' |  {config[bin_singularity][samtools]} view -b {config[alignment_samtools_flags]} - | {config[bin_singularity][samtools]} sort -m 4G > {output.bam}
-        {config[bin_singularity][samtools]} index {output.bam}
+        {config[bin_singularity][python]} {config[sbin_singularity][alignment_sam2bam.py]} {input.sam} {output.bam} --rg {wildcards.batch} --flags='{config[alignment_samtools_flags]}' --threads {threads} --memory 4000 --stats {output.stats}
         """
 
+# alignment of super-batch, split into sorted and indexed batches
+rule aligner_super_batch:
+    input:
+        sequences = lambda wildcards: get_super_batch_sequences(wildcards, config),
+        reference = lambda wildcards: get_super_batch_reference(wildcards, config)
+    output:
+        directory("alignments/{aligner, (minimap2|graphmap2|ngmlr)}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/super_{group, [0-9]+}.{reference, [^.]*}")
+    shadow: "minimal"
+    threads: config['threads_alignment']
+    resources:
+        threads = lambda wildcards, threads: threads,
+        mem_mb = lambda wildcards, threads, attempt: int((1.0 + (0.2 * (attempt - 1))) * max(5000,
+            1000 + 1.1 * get_minimap2_index_mb(wildcards, config) + config['memory']['minimap2'][1] * threads if wildcards.aligner == 'minimap2' else
+            config['memory'][wildcards.aligner][0] + config['memory'][wildcards.aligner][1] * threads)),
+        time_min = lambda wildcards, threads, attempt: int(({'minimap2': 960, 'graphmap2': 1440, 'ngmlr': 5760}[wildcards.aligner] / threads) * attempt * config['runtime'][wildcards.aligner] * get_super_batch_size(config))
+    params:
+        aligner = lambda wildcards, input: get_super_batch_aligner(wildcards, input, config)
+    singularity:
+        config['singularity_images']['alignment']
+    shell:
+        """
+        THREADS={threads}
+        cat {input.sequences} > sequences.fastq.gz
+        {params.aligner} 2> >(tee aligner.log >&2) | {config[bin_singularity][python]} {config[sbin_singularity][alignment_split.py]} sam/ {input.sequences}
+        if [ $(grep 'ERROR' aligner.log | wc -l) -gt 0 ]; then exit 1; fi
+        mkdir -p {output}
+        for sam in sam/*.sam; do
+            batch=`basename $sam .sam`
+            {config[bin_singularity][python]} {config[sbin_singularity][alignment_sam2bam.py]} $sam {output}/$batch.{wildcards.reference}.bam --flags='{config[alignment_samtools_flags]}' --threads {threads} --memory 4000 --stats {output}/$batch.{wildcards.reference}.stats.hdf5
+        done
+        """
+
+# batch alignment from super-batch
+if get_super_batch_size(config) > 1:
+    localrules: aligner_super_batch_split
+    ruleorder: aligner_super_batch_split > aligner_sam2bam
+
+    rule aligner_super_batch_split:
+        input:
+            lambda wildcards: "alignments/{aligner}/{sequence_workflow}/batches/{tag}/{runname}/super_{group}.{reference}".format(
+                aligner=wildcards.aligner,
+                sequence_workflow=wildcards.sequence_workflow,
+                tag=wildcards.tag,
+                runname=wildcards.runname,
+                group=get_super_batch_group(wildcards, config),
+                reference=wildcards.reference)
+        output:
+            bam = "alignments/{aligner, (minimap2|graphmap2|ngmlr)}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference, [^.]*}.bam",
+            bai = "alignments/{aligner, (minimap2|graphmap2|ngmlr)}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference, [^.]*}.bam.bai",
+            stats = "alignments/{aligner, (minimap2|graphmap2|ngmlr)}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}/{batch, [^.]*}.{reference, [^.]*}.stats.hdf5"
+        run:
+            import shutil
+            for f in [output.bam, output.bai, output.stats]:
+                src = os.path.join(input[0], os.path.basename(f))
+                try:
+                    os.link(src, f)
+                except OSError:
+                    shutil.copyfile(src, f)
+                # batch needs to be newer than super-batch directory
+                os.utime(f)
+
 rule aligner_merge_batches_names:
     input:
         bam = lambda wildcards: get_batches_aligner(wildcards, config)
@@ -283,9 +466,10 @@ rule aligner_1D2:
         """
 
 # mapping stats
+# batch statistics are written together with the batch alignments
 rule aligner_stats:
     input:
-        "alignments/{aligner}/{sequence_workflow}/batches/{tag}/{runname}.{reference}.txt"
+        lambda wildcards: get_batches_aligner_stats(wildcards, config)
     output:
         "alignments/{aligner, [^.\/]*}/{sequence_workflow}/batches/{tag, [^\/]*}/{runname, [^.\/]*}.{reference, [^.]*}.hdf5"
     threads: config.get('threads_samtools') or 1
@@ -295,7 +479,7 @@ rule aligner_stats:
         config['singularity_images']['alignment']
     shell:
         """
-        while IFS= read -r bam_file; do {config[bin_singularity][samtools]} view ${{bam_file}}; done < {input} | {config[bin_singularity][python]} {config[sbin_singularity][alignment_stats.py]} {output}
+        {config[bin_singularity][python]} {config[sbin_singularity][alignment_stats.py]} {output} {input} --processes {threads}
         """
 
 # coverage
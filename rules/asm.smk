@@ -59,7 +59,8 @@ rule flye:
         """
         flye_dir=`dirname {config[bin_singularity][python]}`
         PATH=$flye_dir:$PATH
-        {config[bin_singularity][python]} {config[bin_singularity][flye]} {params.flye_flags} -g {params.genome_size} -t {threads} {params.flye_preset} {input.seq} -o {params.out_prefix}
+        SEQ=`{config[bin_singularity][python]} {config[sbin_singularity][basecalling_manifest.py]} files {input.seq}`
+        {config[bin_singularity][python]} {config[bin_singularity][flye]} {params.flye_flags} -g {params.genome_size} -t {threads} {params.flye_preset} $SEQ -o {params.out_prefix}
         mv {params.out_prefix}/assembly.fasta {output.fa}
         """
 
@@ -83,9 +84,10 @@ rule wtdbg2:
     shell:
         """
         mkdir -p {params.out_prefix}
-        {config[bin_singularity][wtdbg2]} {params.wtdbg2_flags} -x {params.wtdbg2_preset} -g {params.genome_size} -t {threads} -fo {params.out_prefix}/dbg -i {input.seq}
+        SEQ=`{config[bin_singularity][python]} {config[sbin_singularity][basecalling_manifest.py]} files {input.seq}`
+        {config[bin_singularity][wtdbg2]} {params.wtdbg2_flags} -x {params.wtdbg2_preset} -g {params.genome_size} -t {threads} -fo {params.out_prefix}/dbg `printf -- ' -i %s' $SEQ`
         {config[bin_singularity][wtpoa-cns]} -t {threads} -i {params.out_prefix}/dbg.ctg.lay.gz -fo {params.out_prefix}/dbg.raw.fa
-        {config[bin_singularity][minimap2]} -t {threads} -ax map-ont -r2k {params.out_prefix}/dbg.raw.fa {input.seq} | {config[bin_singularity][samtools]} sort -@ 4 > {params.out_prefix}/dbg.bam
+        {config[bin_singularity][minimap2]} -t {threads} -ax map-ont -r2k {params.out_prefix}/dbg.raw.fa $SEQ | {config[bin_singularity][samtools]} sort -@ 4 > {params.out_prefix}/dbg.bam
         samtools view -F0x900 {params.out_prefix}/dbg.bam | {config[bin_singularity][wtpoa-cns]} -t {threads} -d {params.out_prefix}/dbg.raw.fa -i - -fo {params.out_prefix}/dbg.cns.fa
         mv {params.out_prefix}/dbg.cns.fa {output.fa}
         """
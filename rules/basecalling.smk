@@ -33,10 +33,10 @@
 # ---------------------------------------------------------------------------------
 # imports
 import os, sys
-from rules.utils.get_file import get_batch_ids_raw, get_signal_batch
+from rules.utils.get_file import get_batch_ids_raw, get_signal_batch, get_signal_cache
 
 # local rules
-localrules: basecaller_merge_batches, basecaller_merge_tag
+localrules: basecaller_merge_batches, basecaller_merge_tag, basecaller_manifest_tag
 
 
 # get batches
@@ -80,18 +80,26 @@ rule guppy:
         guppy_config = lambda wildcards : '-c {cfg}{flags}'.format(
                             cfg = config.get('basecalling_guppy_config') or 'dna_r9.4.1_450bps_fast.cfg',
                             flags = ' --fast5_out' if config.get('basecalling_guppy_config') and 'modbases' in config['basecalling_guppy_config'] else ''),
-        guppy_server = lambda wildcards, input : '' if (config.get('basecalling_guppy_flags') and '--port' in config['basecalling_guppy_flags']) else '--port ' + config['basecalling_guppy_server'][hash(input.batch) % len(config['basecalling_guppy_server'])] if config.get('basecalling_guppy_server') else '',
+        guppy_server = lambda wildcards : '' if (config.get('basecalling_guppy_flags') and '--port' in config['basecalling_guppy_flags']) else ' '.join(config['basecalling_guppy_server']) if config.get('basecalling_guppy_server') else '',
+        guppy_leases = os.path.abspath(os.path.join('.snakemake', 'guppy_server.leases')),
         guppy_flags = lambda wildcards : config.get('basecalling_guppy_flags') or '',
         filtering = lambda wildcards : '--qscore_filtering --min_qscore {score}'.format(score = config['basecalling_guppy_qscore_filter']) if config['basecalling_guppy_qscore_filter'] > 0 else '',
         index = lambda wildcards : '--index ' + os.path.join(config['storage_data_raw'], wildcards.runname, 'reads.fofn') if get_signal_batch(wildcards, config).endswith('.txt') else '',
+        cache = lambda wildcards : get_signal_cache(config),
         mod_table = lambda wildcards, input, output : output[2] if len(output) == 3 else ''
     singularity:
         config['singularity_images']['basecalling']
     shell:
         """
         mkdir -p raw
-        {config[bin_singularity][python]} {config[sbin_singularity][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} --output_format bulk
-        {config[bin_singularity][guppy_basecaller]} -i raw/ --recursive --num_callers 1 --cpu_threads_per_caller {threads} -s workspace/ {params.guppy_config}  {params.filtering} {params.guppy_flags} {params.guppy_server}
+        {config[bin_singularity][python]} {config[sbin_singularity][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} {params.cache} --output_format bulk
+        GUPPY_SERVER=''
+        if [ \'{params.guppy_server}\' != '' ]; then
+            read LEASE_ID GUPPY_PORT <<< $({config[bin_singularity][python]} {config[sbin_singularity][basecalling_guppy_server.py]} lease {params.guppy_leases} {params.guppy_server} --weight `du -sbL raw/ | cut -f1`)
+            trap "{config[bin_singularity][python]} {config[sbin_singularity][basecalling_guppy_server.py]} release {params.guppy_leases} $LEASE_ID" EXIT
+            GUPPY_SERVER="--port $GUPPY_PORT"
+        fi
+        {config[bin_singularity][guppy_basecaller]} -i raw/ --recursive --num_callers 1 --cpu_threads_per_caller {threads} -s workspace/ {params.guppy_config}  {params.filtering} {params.guppy_flags} $GUPPY_SERVER
         FASTQ_DIR='workspace/pass'
         if [ \'{params.filtering}\' = '' ]; then
             FASTQ_DIR='workspace'
@@ -118,19 +126,16 @@ rule flappie:
         mem_mb = lambda wildcards, threads, attempt: int((1.0 + (0.1 * (attempt - 1))) * (config['memory']['flappie'][0] + config['memory']['flappie'][1] * threads)),
         time_min = lambda wildcards, threads, attempt: int((5760 / threads) * attempt * config['runtime']['flappie']) # 360 min / 16 threads
     params:
-        index = lambda wildcards : '--index ' + os.path.join(config['storage_data_raw'], wildcards.runname, 'reads.fofn') if get_signal_batch(wildcards, config).endswith('.txt') else ''
+        index = lambda wildcards : '--index ' + os.path.join(config['storage_data_raw'], wildcards.runname, 'reads.fofn') if get_signal_batch(wildcards, config).endswith('.txt') else '',
+        cache = lambda wildcards : get_signal_cache(config)
     singularity:
         config['singularity_images']['basecalling']
     shell:
         """
         export OPENBLAS_NUM_THREADS=1
         mkdir -p raw
-        {config[bin_singularity][python]} {config[sbin_singularity][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} --output_format single
-        find raw/ -regextype posix-extended -regex '^.*fast5' -type f -exec du -h {{}} + | sort -r -h | cut -f2 > raw.fofn
-        split -e -n r/{threads} raw.fofn raw.fofn.part.
-        ls raw.fofn.part.* | xargs -n 1 -P {threads} -I {{}} $SHELL -c 'cat {{}} | shuf | xargs -n 1 {config[bin_singularity][flappie]} --model {config[basecalling_flappie_model]} {config[basecalling_flappie_flags]} > raw/{{}}.fastq'
-        find ./raw -regextype posix-extended -regex '^.*f(ast)?q' -exec cat {{}} \; > {wildcards.batch}.fq
-        cat {wildcards.batch}.fq | {config[bin_singularity][python]} {config[sbin_singularity][methylation_flappie.py]} split methyl_marks.tsv | gzip > {output.sequence}
+        {config[bin_singularity][python]} {config[sbin_singularity][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} {params.cache} --output_format single
+        {config[bin_singularity][python]} {config[sbin_singularity][basecalling_flappie.py]} raw/ --flappie {config[bin_singularity][flappie]} --model {config[basecalling_flappie_model]} --flags '{config[basecalling_flappie_flags]}' --threads {threads} | {config[bin_singularity][python]} {config[sbin_singularity][methylation_flappie.py]} split methyl_marks.tsv | gzip > {output.sequence}
         cat methyl_marks.tsv | gzip > {output.methyl_marks}
         """
 
@@ -141,10 +146,8 @@ rule basecaller_merge_batches:
     output:
         "sequences/{sequence_workflow, ((?!batches).)*}/batches/{tag, [^\/]*}/{runname, [^.\/]*}.fastq.gz"
     run:
-        with open(output[0], 'wb') as fp_out:
-            for f in input:
-                with open(f, 'rb') as fp_in:
-                    fp_out.write(fp_in.read())
+        from rules.utils.basecalling_manifest import sequence_manifest
+        sequence_manifest.cat(input, output=output[0])
 
 rule basecaller_merge_tag:
     input:
@@ -152,31 +155,65 @@ rule basecaller_merge_tag:
     output:
         "sequences/{sequence_workflow, ((?!batches).)*}/{tag, [^\/]*}.fastq.gz"
     run:
-        with open(output[0], 'wb') as fp_out:
-            for f in input:
-                with open(f, 'rb') as fp_in:
-                    fp_out.write(fp_in.read())
+        from rules.utils.basecalling_manifest import sequence_manifest
+        sequence_manifest.cat(input, output=output[0])
 
-rule basecaller_stats:
+# ordered list of batches instead of merged sequences
+rule basecaller_manifest_batches:
     input:
         lambda wildcards: get_batches_basecaller(wildcards)
+    output:
+        "sequences/{sequence_workflow, ((?!batches).)*}/batches/{tag, [^\/]*}/{runname, [^.\/]*}.fastq.manifest"
+    resources:
+        mem_mb = lambda wildcards, attempt: int((1.0 + (0.1 * (attempt - 1))) * 1000),
+        time_min = 60
+    shell:
+        """
+        {config[bin][python]} {config[sbin][basecalling_manifest.py]} write {output} {input}
+        """
+
+rule basecaller_manifest_tag:
+    input:
+        lambda wildcards: ["sequences/{sequence_workflow}/batches/{tag}/{runname}.fastq.manifest".format(
+            sequence_workflow=wildcards.sequence_workflow, tag=wildcards.tag, runname=runname) for runname in config['runnames']]
+    output:
+        "sequences/{sequence_workflow, ((?!batches).)*}/{tag, [^\/]*}.fastq.manifest"
+    shell:
+        """
+        {config[bin][python]} {config[sbin][basecalling_manifest.py]} write {output} {input}
+        """
+
+# merge guppy sequencing summaries into typed run summary
+rule basecaller_summary:
+    input:
+        lambda wildcards: [f[:-len('.fastq.gz')] + '.sequencing_summary.txt' for f in get_batches_basecaller(wildcards)]
+    output:
+        "sequences/{sequence_workflow, guppy}/batches/{tag, [^\/]*}/{runname, [^.\/]*}.sequencing_summary.hdf5"
+    resources:
+        mem_mb = lambda wildcards, attempt: int((1.0 + (0.1 * (attempt - 1))) * 4000),
+        time_min = 60
+    shell:
+        """
+        {config[bin][python]} {config[sbin][basecalling_stats.py]} merge {output} {input}
+        """
+
+# read length and quality from guppy run summary or fastq output
+rule basecaller_stats:
+    input:
+        lambda wildcards: ["sequences/{sequence_workflow}/batches/{tag}/{runname}.sequencing_summary.hdf5".format(
+            sequence_workflow=wildcards.sequence_workflow, tag=wildcards.tag, runname=wildcards.runname)]
+            if wildcards.sequence_workflow == 'guppy' else get_batches_basecaller(wildcards)
     output:
         "sequences/{sequence_workflow, ((?!batches).)*}/batches/{tag, [^\/]*}/{runname, [^.\/]*}.hdf5"
-    run:
-        import gzip
-        import pandas as pd
-        def fastq_iter(iterable):
-            while True:
-                try:
-                    title = next(iterable)
-                    assert title[0] == '@'
-                    seq = next(iterable)
-                    _ = next(iterable)
-                    qual = next(iterable)
-                except StopIteration:
-                    return
-                mean_q = sum([ord(x) - 33 for x in qual]) / len(qual) if qual else 0.0
-                yield len(seq), mean_q
-        line_iter = (line for f in input for line in gzip.open(f, 'rb').read().decode('utf-8').split('\n') if line)
-        df = pd.DataFrame(fastq_iter(line_iter), columns=['length', 'quality'])
-        df.to_hdf(output[0], 'stats')
+    threads: config.get('threads_basecalling') or 1
+    resources:
+        threads = lambda wildcards, threads: threads,
+        mem_mb = lambda wildcards, threads, attempt: int((1.0 + (0.1 * (attempt - 1))) * (4000 + 500 * threads)),
+        time_min = 60
+    params:
+        command = lambda wildcards: ('summary' + (' --pass_only' if config.get('basecalling_guppy_qscore_filter') else '')
+            if wildcards.sequence_workflow == 'guppy' else 'fastq --processes {threads}'.format(threads=config.get('threads_basecalling') or 1))
+    shell:
+        """
+        {config[bin][python]} {config[sbin][basecalling_stats.py]} {params.command} {output} {input}
+        """
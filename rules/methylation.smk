@@ -34,7 +34,7 @@
 # imports
 import os, re
 import gzip
-from rules.utils.get_file import get_batch_ids_raw, get_signal_batch, get_sequence_batch, get_alignment_batch
+from rules.utils.get_file import get_batch_ids_raw, get_signal_batch, get_signal_cache, get_sequence_batch, get_alignment_batch
 # local rules
 localrules: methylation_merge_nanopolish_raw_run
 localrules: methylation_merge_run, methylation_frequencies
@@ -96,13 +96,14 @@ rule methylation_nanopolish:
         time_min = lambda wildcards, input, threads, attempt: int((960 / threads) * attempt * config['runtime']['nanopolish'])   # 60 min / 16 threads
     params:
         index = lambda wildcards : '--index ' + os.path.join(config['storage_data_raw'], wildcards.runname, 'reads.fofn') if get_signal_batch(wildcards, config).endswith('.txt') else '',
+        cache = lambda wildcards : get_signal_cache(config),
         raw_out = lambda wildcards, input, output : output[1] if len(output) == 2 else 't'
     singularity:
         config['singularity_images']['methylation']
     shell:
         """
         mkdir -p raw
-        {config[bin_singularity][python]} {config[sbin_singularity][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} --output_format lazy
+        {config[bin_singularity][python]} {config[sbin_singularity][storage_fast5Index.py]} extract {input.batch} raw/ {params.index} {params.cache} --output_format lazy
         zcat {input.sequences} > sequences.fastx
         {config[bin_singularity][nanopolish]} index -d raw/ sequences.fastx
         {config[bin_singularity][nanopolish]} call-methylation -t {threads} -r sequences.fastx -g {input.reference} -b {input.bam} > tmp.tsv
@@ -39,26 +39,30 @@ localrules: storage_index_run, storage_extract
 LOC_RAW = "/Raw/"
 
 def get_batches_indexing(wildcards):
-    return expand("{data_raw}/{runname}/reads/{batch}.fofn",
+    return expand("{data_raw}/{runname}/reads/{batch}.{ext}",
         data_raw = config["storage_data_raw"],
         runname=wildcards.runname,
-        batch=get_batch_ids_raw(wildcards, config=config))
+        batch=get_batch_ids_raw(wildcards, config=config),
+        ext=['fofn', 'qc.hdf5'] if config.get('storage_index_qc') else ['fofn'])
 
 # extract read ID from individual fast5 files
 rule storage_index_batch:
     input:
         batch = lambda wildcards : get_signal_batch(wildcards, config)
     output:
-        temp("{data_raw}/{{runname, [^.\/]*}}/reads/{{batch}}.fofn".format(data_raw = config["storage_data_raw"]))
+        ["{data_raw}/{{runname, [^.\/]*}}/reads/{{batch}}.fofn".format(data_raw = config["storage_data_raw"])] +
+        (["{data_raw}/{{runname, [^.\/]*}}/reads/{{batch}}.qc.hdf5".format(data_raw = config["storage_data_raw"])] if config.get('storage_index_qc') else [])
     shadow: "shallow"
-    threads: 1
+    threads: config.get('threads_storage') or 1
     resources:
         threads = lambda wildcards, threads: threads,
         mem_mb = lambda wildcards, attempt: int((1.0 + (0.1 * (attempt - 1))) * 4000),
         time_min = 15
+    params:
+        qc = lambda wildcards, output : '--qc ' + output[1] if len(output) == 2 else ''
     shell:
         """
-        {config[bin][python]} {config[sbin][storage_fast5Index.py]} index {input.batch} --out_prefix reads --tmp_prefix $(pwd) > {output}
+        {config[bin][python]} {config[sbin][storage_fast5Index.py]} index {input.batch} --out_prefix reads --processes {threads} --tar_offsets {params.qc} > {output[0]}
         """
 
 # merge batch indices
@@ -66,11 +70,36 @@ rule storage_index_run:
     input:
         batches = get_batches_indexing
     output:
-        fofn = "{data_raw}/{{runname, [^.\/]*}}/reads.fofn".format(data_raw = config["storage_data_raw"])
+        (["{data_raw}/{{runname, [^.\/]*}}/reads.qc.hdf5".format(data_raw = config["storage_data_raw"])] if config.get('storage_index_qc') else []),
+        fofn = "{data_raw}/{{runname, [^.\/]*}}/reads.fofn".format(data_raw = config["storage_data_raw"]),
+        idx = "{data_raw}/{{runname, [^.\/]*}}/reads.idx".format(data_raw = config["storage_data_raw"])
     run:
-        with open(output[0], 'w') as fp:
-            for f in input.batches:
-                print(open(f, 'r').read(), end='', file=fp)
+        from rules.utils.storage_fast5Index import batch_manifest
+        # batch fragments are kept, the manifest tracks their batches for incremental updates
+        manifest = batch_manifest(os.path.join(config['storage_data_raw'], wildcards.runname))
+        manifest.update(qc=bool(config.get('storage_index_qc')))
+        manifest.merge(output.fofn, output.idx)
+        if config.get('storage_index_qc'):
+            manifest.merge_qc(output[0])
+
+# repack tar archived single reads into compressed bulk-fast5
+rule storage_repack_run:
+    input:
+        fofn = "{data_raw}/{{runname}}/reads.fofn".format(data_raw = config["storage_data_raw"])
+    output:
+        "{data_raw}/{{runname, [^.\/]*}}/reads.repack".format(data_raw = config["storage_data_raw"])
+    params:
+        run_dir = lambda wildcards : os.path.join(config["storage_data_raw"], wildcards.runname),
+        compression = config.get('storage_repack_compression') or 'vbz'
+    threads: config.get('threads_storage') or 1
+    resources:
+        threads = lambda wildcards, threads: threads,
+        mem_mb = lambda wildcards, threads, attempt: int((1.0 + (0.1 * (attempt - 1))) * (4000 + 2000 * threads)),
+        time_min = 240
+    shell:
+        """
+        {config[bin][python]} {config[sbin][storage_fast5Index.py]} repack {params.run_dir} --processes {threads} --compression {params.compression} > {output}
+        """
 
  # index multiple runs
 rule storage_index_runs:
@@ -0,0 +1,169 @@
+# \HEADER\-------------------------------------------------------------------------
+#
+#  CONTENTS      : SAM to sorted and indexed BAM
+#
+#  DESCRIPTION   : Read group, filter, sort, index and statistics in a single process
+#
+#  RESTRICTIONS  : none
+#
+#  REQUIRES      : none
+#
+# ---------------------------------------------------------------------------------
+# Copyright (c) 2018-2021, Pay Giesselmann, Max Planck Institute for Molecular Genetics
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Written by Pay Giesselmann
+# ---------------------------------------------------------------------------------
+import os, sys
+import heapq
+import shutil
+import argparse
+import tempfile
+import pysam
+from alignment_stats import alignment_stats, stat_columns
+
+
+
+
+class sam2bam():
+    def __init__(self, output, header, threads=1, memory=4000, tmp_dir=None,
+            rg=None, flags_require=0, flags_exclude=0, min_mapq=0, stats=None, stats_block_size=1<<14):
+        self.output = output
+        self.stats = stats
+        self.stats_block_size = stats_block_size
+        self.threads = threads
+        self.memory = memory * 1e6
+        self.tmp_dir = tmp_dir
+        self.rg = rg
+        self.flags_require = flags_require
+        self.flags_exclude = flags_exclude
+        self.min_mapq = min_mapq
+        header = header.to_dict()
+        header['HD'] = dict(header.get('HD', {'VN': '1.6'}), SO='coordinate')
+        if rg:
+            header['RG'] = [r for r in header.get('RG', []) if r['ID'] != rg] + [{'ID': rg}]
+        self.header = pysam.AlignmentHeader.from_dict(header)
+        self.chunks = []
+
+    # coordinate order with unmapped reads last
+    def __key__(rec):
+        return (rec.reference_id if rec.reference_id >= 0 else sys.maxsize, rec.reference_start, rec.is_reverse)
+
+    # approximate memory of record in sort buffer
+    def __size__(rec):
+        return 300 + 2 * rec.query_length + 4 * len(rec.cigartuples or [])
+
+    def __filter__(self, rec):
+        return ((rec.flag & self.flags_require) == self.flags_require and
+                not rec.flag & self.flags_exclude and
+                rec.mapping_quality >= self.min_mapq)
+
+    # write sorted buffer as uncompressed temporary BAM
+    def __spill__(self, buffer, tmp_dir):
+        chunk = os.path.join(tmp_dir, '{}.bam'.format(len(self.chunks)))
+        buffer.sort(key=sam2bam.__key__)
+        with pysam.AlignmentFile(chunk, 'wb0', header=self.header) as fp:
+            for rec in buffer:
+                fp.write(rec)
+        self.chunks.append(chunk)
+
+    def run(self, records):
+        buffer = []
+        buffer_size = 0
+        tmp_dir = None
+        stats = stat_columns() if self.stats else None
+        stats_block = []
+        try:
+            for rec in records:
+                if not self.__filter__(rec):
+                    continue
+                if self.rg:
+                    rec.set_tag('RG', self.rg, value_type='Z')
+                buffer.append(rec)
+                buffer_size += sam2bam.__size__(rec)
+                if buffer_size > self.memory:
+                    tmp_dir = tmp_dir or tempfile.mkdtemp(prefix='sam2bam_', dir=self.tmp_dir)
+                    self.__spill__(buffer, tmp_dir)
+                    buffer = []
+                    buffer_size = 0
+            buffer.sort(key=sam2bam.__key__)
+            # merge in memory buffer with spilled chunks
+            chunk_files = [pysam.AlignmentFile(chunk, 'rb', check_sq=False) for chunk in self.chunks]
+            try:
+                with pysam.AlignmentFile(self.output + '.tmp', 'wb', header=self.header, threads=self.threads) as fp:
+                    for rec in heapq.merge(buffer, *[iter(f.fetch(until_eof=True)) for f in chunk_files], key=sam2bam.__key__):
+                        fp.write(rec)
+                        # statistics of written records in blocks of decoded cigars
+                        if stats is not None:
+                            stats_block.append(alignment_stats.bam_fields(rec))
+                            if len(stats_block) >= self.stats_block_size:
+                                alignment_stats.fields_block(stats_block, stats)
+                                stats_block = []
+                if stats_block:
+                    alignment_stats.fields_block(stats_block, stats)
+            finally:
+                for f in chunk_files:
+                    f.close()
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.replace(self.output + '.tmp', self.output)
+        pysam.index(self.output, '-@', str(self.threads))
+        if stats is not None:
+            stats.to_df().to_hdf(self.stats, key='stats')
+
+
+
+
+# samtools view filter flags
+def parse_flags(flags):
+    def flag(value):
+        return int(value, 0)
+    parser = argparse.ArgumentParser(prog='samtools flags', add_help=False)
+    parser.add_argument("-f", type=flag, default=0)
+    parser.add_argument("-F", type=flag, default=0)
+    parser.add_argument("-q", type=int, default=0)
+    args, unknown = parser.parse_known_args(flags.split())
+    if unknown:
+        raise ValueError("[ERROR] Unsupported samtools flags: {}".format(' '.join(unknown)))
+    return args
+
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert SAM to sorted and indexed BAM")
+    parser.add_argument("input", help="Input SAM, - for stdin")
+    parser.add_argument("output", help="Output BAM")
+    parser.add_argument("--rg", default=None, help="Read group added to header and records")
+    parser.add_argument("--flags", default='', help="samtools view filter flags (-f, -F, -q)")
+    parser.add_argument("--threads", type=int, default=1, help="BGZF compression threads")
+    parser.add_argument("--memory", type=float, default=4000, help="Approximate sort memory in MB before spilling to disk")
+    parser.add_argument("--tmp_dir", default=None, help="Directory for spilled chunks, default TMPDIR")
+    parser.add_argument("--stats", default=None, help="Write read statistics of output records to HDF5")
+    args = parser.parse_args()
+    try:
+        flags = parse_flags(args.flags)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        exit(1)
+    with pysam.AlignmentFile(args.input, 'r', check_sq=False) as fp_in:
+        sam2bam(args.output, fp_in.header, threads=args.threads, memory=args.memory, tmp_dir=args.tmp_dir,
+            rg=args.rg, flags_require=flags.f, flags_exclude=flags.F, min_mapq=flags.q, stats=args.stats).run(fp_in.fetch(until_eof=True))
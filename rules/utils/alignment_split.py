@@ -0,0 +1,87 @@
+# \HEADER\-------------------------------------------------------------------------
+#
+#  CONTENTS      : Split alignments of super-batches
+#
+#  DESCRIPTION   : Split SAM stream into sequence batches with read groups
+#
+#  RESTRICTIONS  : none
+#
+#  REQUIRES      : none
+#
+# ---------------------------------------------------------------------------------
+# Copyright (c) 2018-2021, Pay Giesselmann, Max Planck Institute for Molecular Genetics
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Written by Pay Giesselmann
+# ---------------------------------------------------------------------------------
+import os, sys
+import gzip
+import argparse
+from signal import signal, SIGPIPE, SIG_DFL
+
+
+
+
+# read IDs of gzip compressed fastq
+def fastq_IDs(fastq):
+    with gzip.open(fastq, 'rb') as fp:
+        for i, line in enumerate(fp):
+            if i % 4 == 0:
+                yield line[1:].split()[0].decode('utf-8')
+
+
+
+
+if __name__ == '__main__':
+    signal(SIGPIPE,SIG_DFL)
+    parser = argparse.ArgumentParser(description="Split SAM from stdin into one SAM per sequence batch")
+    parser.add_argument("output", help="Output directory")
+    parser.add_argument("sequences", nargs="+", help="Sequence batches as fastq.gz")
+    args = parser.parse_args()
+    # read to batch mapping
+    batches = [os.path.basename(f)[:-len('.fastq.gz')] for f in args.sequences]
+    read_batch = {}
+    for batch, f in zip(batches, args.sequences):
+        read_batch.update({ID:batch for ID in fastq_IDs(f)})
+    os.makedirs(args.output, exist_ok=True)
+    fp_out = {batch:open(os.path.join(args.output, batch + '.sam'), 'w') for batch in batches}
+    header = []
+    for line in sys.stdin:
+        if line.startswith('@'):
+            header.append(line)
+            continue
+        if header is not None:
+            # header of each batch with own read group
+            for batch, fp in fp_out.items():
+                fp.write(''.join(header))
+                fp.write('@RG\tID:{}\n'.format(batch))
+            header = None
+        QNAME = line[:line.find('\t')]
+        batch = read_batch.get(QNAME)
+        if batch is None:
+            print("[ERROR] Read {} not found in sequence batches".format(QNAME), file=sys.stderr)
+            exit(1)
+        fp_out[batch].write(line.rstrip('\n') + '\tRG:Z:' + batch + '\n')
+    if header is not None:
+        for batch, fp in fp_out.items():
+            fp.write(''.join(header))
+            fp.write('@RG\tID:{}\n'.format(batch))
+    for fp in fp_out.values():
+        fp.close()
@@ -31,27 +31,160 @@
 #
 # Written by Pay Giesselmann
 # ---------------------------------------------------------------------------------
-import sys, re
+import sys
 import argparse
+import numpy as np
 import pandas as pd
+from multiprocessing import Pool
 from signal import signal, SIGPIPE, SIG_DFL
 
 
 
 
-# helper
-# decode cigar into list of edits
-def decodeCigar(cigar):
-    ops = [(int(op[:-1]), op[-1]) for op in re.findall('(\d*\D)',cigar) if op[:-1]]
-    return ops
+# typed columns with amortized growth
+class stat_columns():
+    dtypes = [('flag', np.int32), ('length', np.int32), ('mapped_length', np.int32), ('nm', np.int32)]
 
+    def __init__(self, capacity=1<<16):
+        self.n = 0
+        self.ID = []
+        self.columns = {name:np.empty(capacity, dtype=dtype) for name, dtype in stat_columns.dtypes}
 
+    def extend(self, ID, **values):
+        m = len(ID)
+        capacity = len(self.columns['flag'])
+        if self.n + m > capacity:
+            capacity = max(2 * capacity, self.n + m)
+            for name, column in self.columns.items():
+                self.columns[name] = np.resize(column, capacity)
+        for name, value in values.items():
+            self.columns[name][self.n:self.n+m] = value
+        self.ID.extend(ID)
+        self.n += m
 
+    def concat(self, other):
+        self.extend(other.ID, **{name:column[:other.n] for name, column in other.columns.items()})
+        return self
 
-# return length of recognized operations in decoded cigar
-def opsLength(ops, recOps='MIS=X'):
-    n = [op[0] for op in ops if op[1] in recOps]
-    return sum(n)
+    def to_df(self):
+        flag, length, mapped_length, nm = [self.columns[name][:self.n] for name, _ in stat_columns.dtypes]
+        df = pd.DataFrame({'ID': pd.Series(self.ID, dtype='object'),
+            'flag': flag, 'length': length, 'mapped_length': mapped_length})
+        if (nm >= 0).any():
+            identity = np.divide(mapped_length - nm, mapped_length, out=np.zeros(self.n, dtype=np.float32), where=mapped_length > 0)
+            df['identity'] = np.where(nm >= 0, identity, np.nan).astype(np.float32)
+        return df
+
+
+
+
+# block wise statistics of SAM records
+class alignment_stats():
+    # cigar operation codes in M, I, D, N, S, H, P, =, X order
+    op_codes = np.full(256, -1, dtype=np.int8)
+    op_codes[np.frombuffer(b'MIDNSHP=X', dtype=np.uint8)] = np.arange(9)
+    length_ops = np.array([1, 1, 0, 0, 1, 0, 0, 1, 1], dtype=bool)
+    mapped_ops = np.array([1, 1, 0, 0, 0, 0, 0, 1, 1], dtype=bool)
+    powers = 10 ** np.arange(19, dtype=np.int64)
+
+    # decode concatenated cigar strings once into op and length arrays
+    # returns read and mapped length per cigar
+    def __cigar_lengths__(cigars):
+        n = len(cigars)
+        b = np.frombuffer(''.join(cigars).encode('ascii'), dtype=np.uint8)
+        if not len(b):
+            return np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)
+        is_digit = (b >= 48) & (b <= 57)
+        op_idx = np.flatnonzero(~is_digit)
+        op_codes = alignment_stats.op_codes[b[op_idx]]
+        # digit value times power of ten given by distance to next op
+        pos = np.arange(len(b))
+        next_op = np.minimum.accumulate(np.where(is_digit, len(b), pos)[::-1])[::-1]
+        contrib = np.where(is_digit, (b.astype(np.int64) - 48) * alignment_stats.powers[np.minimum(next_op - pos - 1, 18)], 0)
+        starts = np.concatenate(([0], op_idx[:-1] + 1))
+        op_lengths = np.add.reduceat(contrib, starts)
+        # cigar of each op
+        ends = np.cumsum([len(c) for c in cigars])
+        op_record = np.searchsorted(ends, op_idx, side='right')
+        valid = op_codes >= 0
+        length = np.bincount(op_record[valid], weights=op_lengths[valid] * alignment_stats.length_ops[op_codes[valid]], minlength=n)
+        mapped_length = np.bincount(op_record[valid], weights=op_lengths[valid] * alignment_stats.mapped_ops[op_codes[valid]], minlength=n)
+        return length.astype(np.int64), mapped_length.astype(np.int64)
+
+    # NM tag value of SAM line or -1
+    def __nm__(line):
+        i = line.find('\tNM:i:')
+        if i < 0:
+            return -1
+        j = line.find('\t', i + 6)
+        return int(line[i+6:j] if j > 0 else line[i+6:].rstrip())
+
+    def sam_block(lines, columns):
+        fields = [line.split('\t', 10) for line in lines]
+        cigars = [f[5] if f[5] != '*' else '' for f in fields]
+        length, mapped_length = alignment_stats.__cigar_lengths__(cigars)
+        no_cigar = np.array([not c for c in cigars], dtype=bool)
+        if no_cigar.any():
+            length[no_cigar] = [len(f[9]) if f[9] != '*' else 0 for f, c in zip(fields, cigars) if not c]
+        columns.extend([f[0] for f in fields],
+            flag=[int(f[1]) for f in fields],
+            length=length, mapped_length=mapped_length,
+            nm=[alignment_stats.__nm__(line) for line in lines])
+
+    # ID, flag, cigar, query length and NM of pysam record
+    def bam_fields(rec):
+        return (rec.query_name, rec.flag, rec.cigarstring or '', rec.query_length,
+            rec.get_tag('NM') if rec.has_tag('NM') else -1)
+
+    def fields_block(fields, columns):
+        ID, flag, cigars, query_length, nm = zip(*fields)
+        length, mapped_length = alignment_stats.__cigar_lengths__(cigars)
+        no_cigar = np.array([not c for c in cigars], dtype=bool)
+        if no_cigar.any():
+            length[no_cigar] = np.array(query_length)[no_cigar]
+        columns.extend(ID, flag=flag, length=length, mapped_length=mapped_length, nm=nm)
+
+    def bam_block(records, columns):
+        alignment_stats.fields_block([alignment_stats.bam_fields(rec) for rec in records], columns)
+
+    # blocks of records limited in number and size e.g. for ultra-long reads
+    def __blocks__(iterable, block_size, max_chars=1<<26, size=len):
+        block = []
+        chars = 0
+        for item in iterable:
+            block.append(item)
+            chars += size(item)
+            if len(block) >= block_size or chars >= max_chars:
+                yield block
+                block = []
+                chars = 0
+        if block:
+            yield block
+
+    def sam(fp, block_size=1<<14):
+        columns = stat_columns()
+        records = (line for line in fp if not line.startswith('@'))
+        for block in alignment_stats.__blocks__(records, block_size):
+            alignment_stats.sam_block(block, columns)
+        return columns
+
+    # statistics table of SAM, BAM or batch statistics file
+    def table(input):
+        if input.endswith('.hdf5'):
+            return pd.read_hdf(input, key='stats')
+        return alignment_stats.file(input).to_df()
+
+    def file(input, block_size=1<<14):
+        if input.endswith('.bam'):
+            import pysam
+            columns = stat_columns()
+            with pysam.AlignmentFile(input, 'rb', check_sq=False) as fp:
+                for block in alignment_stats.__blocks__(fp.fetch(until_eof=True), block_size, size=lambda rec : len(rec.cigarstring or '')):
+                    alignment_stats.bam_block(block, columns)
+            return columns
+        else:
+            with open(input, 'r') as fp:
+                return alignment_stats.sam(fp, block_size=block_size)
 
 
 
@@ -61,32 +194,13 @@ if __name__ == '__main__':
     # cmd arguments
     parser = argparse.ArgumentParser(description="Compute summary from alignments")
     parser.add_argument("output", help="output file")
+    parser.add_argument("inputs", nargs="*", help="SAM, BAM or batch statistics (.hdf5) files, SAM from stdin if empty")
+    parser.add_argument("--processes", type=int, default=1, help="Parallel processes for multiple inputs")
+    parser.add_argument("--block_size", type=int, default=1<<14, help="Records per block")
     args = parser.parse_args()
-    def sam_parser(iterable):
-        while True:
-            try:
-                line = next(iterable)
-            except StopIteration:
-                return
-            fields = line.strip().split('\t')
-            opt_fields = [tuple(x.split(':')) for x in fields[11:]]
-            opt_nm = [f[2] for f in opt_fields if f[0] == 'NM']
-            cigar = fields[5]
-            length = opsLength(decodeCigar(cigar), recOps='MIS=X') if cigar != "*" else len(fields[9]) if fields[9] != "*" else 0
-            mapped_length = opsLength(decodeCigar(cigar), recOps='MI=X') if cigar != "*" else 0
-            if opt_nm:
-                nm = int(opt_nm[0])
-                blast_identity = ((mapped_length-nm)/float(mapped_length)) if mapped_length > 0 else 0.0
-                yield fields[0], int(fields[1]), length, mapped_length, blast_identity
-            else:
-                yield fields[0], int(fields[1]), length, mapped_length
-    record_iter = (line for line in sys.stdin if not line.startswith('@'))
-    stat_iter = (sam_parser(record_iter))
-    df = pd.DataFrame(stat_iter)
-    if df.shape[1] == 2:
-        df.columns = ['ID', 'flag', 'length', 'mapped_length']
-        df = df.astype({'ID': 'object', 'flag': 'int32', 'length': 'int32', 'mapped_length': 'int32'})
+    if args.inputs:
+        with Pool(processes=max(1, min(args.processes, len(args.inputs)))) as pool:
+            df = pd.concat(pool.imap(alignment_stats.table, args.inputs), ignore_index=True, sort=False)
     else:
-        df.columns = ['ID', 'flag', 'length', 'mapped_length', 'identity']
-        df = df.astype({'ID': 'object', 'flag': 'int32', 'length': 'int32', 'mapped_length': 'int32', 'identity': 'float32'})
-    df.to_hdf(args.output, 'stats')
+        df = alignment_stats.sam(sys.stdin, block_size=args.block_size).to_df()
+    df.to_hdf(args.output, key='stats')
@@ -0,0 +1,115 @@
+# \HEADER\-------------------------------------------------------------------------
+#
+#  CONTENTS      : Flappie basecalling driver
+#
+#  DESCRIPTION   : Size balanced batched flappie invocation
+#
+#  RESTRICTIONS  : none
+#
+#  REQUIRES      : none
+#
+# ---------------------------------------------------------------------------------
+# Copyright (c) 2018-2021, Pay Giesselmann, Max Planck Institute for Molecular Genetics
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Written by Pay Giesselmann
+# ---------------------------------------------------------------------------------
+import os, sys
+import heapq
+import argparse
+import threading
+import subprocess
+import h5py
+from signal import signal, SIGPIPE, SIG_DFL
+
+
+
+
+class flappie_driver():
+    def __init__(self, flappie, flappie_args=[], threads=1, files_per_call=50):
+        self.flappie = flappie
+        self.flappie_args = flappie_args
+        self.threads = threads
+        self.files_per_call = files_per_call
+        self.lock = threading.Lock()
+        self.errors = []
+
+    # signal length from dataset shape without reading the signal
+    # unreadable files are estimated from file size with 2 bytes per int16 sample
+    def __signal_length__(f5_file):
+        try:
+            with h5py.File(f5_file, 'r') as f5:
+                raw = f5['/Raw/Reads']
+                return sum(read['Signal'].shape[0] for read in raw.values())
+        except (OSError, KeyError):
+            return os.path.getsize(f5_file) // 2
+
+    # longest processing time first, each read to the least loaded worker
+    def __partition__(files, workers):
+        lengths = sorted(((flappie_driver.__signal_length__(f), f) for f in files), reverse=True)
+        heap = [(0, i) for i in range(workers)]
+        partitions = [[] for _ in range(workers)]
+        for length, f in lengths:
+            load, i = heapq.heappop(heap)
+            partitions[i].append(f)
+            heapq.heappush(heap, (load + length, i))
+        return partitions
+
+    # worker calls flappie on chunks of its reads, fastq is written by whole chunks
+    def __worker__(self, files, output):
+        for i in range(0, len(files), self.files_per_call):
+            chunk = files[i:i+self.files_per_call]
+            proc = subprocess.Popen([self.flappie] + self.flappie_args + chunk, stdout=subprocess.PIPE)
+            stdout, _ = proc.communicate()
+            with self.lock:
+                if proc.returncode != 0:
+                    self.errors.append((proc.returncode, chunk))
+                    return
+                output.write(stdout)
+                output.flush()
+
+    def run(self, files, output):
+        partitions = flappie_driver.__partition__(files, max(1, min(self.threads, len(files))))
+        workers = [threading.Thread(target=self.__worker__, args=(partition, output)) for partition in partitions]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for returncode, chunk in self.errors:
+            print("[ERROR] flappie exited with {} on {} reads starting at {}".format(returncode, len(chunk), chunk[0]), file=sys.stderr)
+        return len(self.errors) == 0
+
+
+
+
+if __name__ == '__main__':
+    signal(SIGPIPE,SIG_DFL)
+    parser = argparse.ArgumentParser(description="Batched flappie basecalling to stdout")
+    parser.add_argument("input", help="Directory of single read fast5 files")
+    parser.add_argument("--flappie", default='flappie', help="Flappie executable")
+    parser.add_argument("--model", default='r941_5mC', help="Flappie model")
+    parser.add_argument("--flags", default='', help="Flappie command line flags")
+    parser.add_argument("--threads", type=int, default=1, help="Parallel flappie processes")
+    parser.add_argument("--files_per_call", type=int, default=50, help="Reads per flappie invocation")
+    args = parser.parse_args()
+    files = sorted([os.path.join(dirpath, f) for dirpath, _, fs in os.walk(args.input, followlinks=True) for f in fs if f.endswith('.fast5')])
+    driver = flappie_driver(args.flappie, ['--model', args.model] + args.flags.split(), threads=args.threads, files_per_call=args.files_per_call)
+    if not driver.run(files, sys.stdout.buffer):
+        exit(1)
@@ -0,0 +1,152 @@
+# \HEADER\-------------------------------------------------------------------------
+#
+#  CONTENTS      : Guppy basecall server dispatcher
+#
+#  DESCRIPTION   : Lease least loaded basecall server to jobs
+#
+#  RESTRICTIONS  : none
+#
+#  REQUIRES      : none
+#
+# ---------------------------------------------------------------------------------
+# Copyright (c) 2018-2021, Pay Giesselmann, Max Planck Institute for Molecular Genetics
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Written by Pay Giesselmann
+# ---------------------------------------------------------------------------------
+import os, sys, json
+import time, uuid, socket
+import errno, fcntl
+import argparse
+
+
+
+
+# leases of basecall servers shared by all jobs of a working directory
+# state file holds one entry per active lease:
+#   id, server, weight, host, pid, time
+class guppy_server_dispatcher():
+    def __init__(self, state_file, timeout=86400):
+        self.state_file = state_file
+        self.timeout = timeout
+
+    # read and write leases under exclusive lock
+    def __locked__(self, fn):
+        with open(self.state_file + '.lock', 'a') as fp_lock:
+            fcntl.flock(fp_lock, fcntl.LOCK_EX)
+            leases = []
+            if os.path.isfile(self.state_file):
+                with open(self.state_file, 'r') as fp:
+                    try:
+                        leases = json.load(fp)
+                    except ValueError:
+                        leases = []
+            leases = [lease for lease in leases if self.__alive__(lease)]
+            leases, result = fn(leases)
+            with open(self.state_file + '.tmp', 'w') as fp:
+                json.dump(leases, fp)
+            os.replace(self.state_file + '.tmp', self.state_file)
+            return result
+
+    # leases expire after timeout or if the job on this host is gone
+    def __alive__(self, lease):
+        if time.time() - lease['time'] > self.timeout:
+            return False
+        if lease['host'] == socket.gethostname():
+            try:
+                os.kill(lease['pid'], 0)
+            except OSError as e:
+                return e.errno == errno.EPERM
+        return True
+
+    # lease least loaded server, load is the summed weight of active leases
+    def lease(self, servers, weight=1, pid=None):
+        def fn(leases):
+            load = {server:(0, 0) for server in servers}
+            for lease in leases:
+                if lease['server'] in load:
+                    w, n = load[lease['server']]
+                    load[lease['server']] = (w + lease['weight'], n + 1)
+            server = min(servers, key=lambda s : load[s])
+            lease = {'id': uuid.uuid4().hex, 'server': server, 'weight': weight,
+                     'host': socket.gethostname(), 'pid': pid or os.getppid(), 'time': time.time()}
+            return leases + [lease], lease
+        return self.__locked__(fn)
+
+    def release(self, lease_id):
+        def fn(leases):
+            return [lease for lease in leases if lease['id'] != lease_id], None
+        self.__locked__(fn)
+
+    def status(self):
+        return self.__locked__(lambda leases : (leases, leases))
+
+
+
+
+class main():
+    def __init__(self):
+        parser = argparse.ArgumentParser(
+        description='Guppy basecall server dispatcher',
+        usage='''basecalling_guppy_server.py <command> [<args>]
+Available commands are:
+   lease      Lease least loaded server, prints lease ID and server
+   release    Release lease
+   status     Print active leases
+''')
+        parser.add_argument('command', help='Subcommand to run')
+        args = parser.parse_args(sys.argv[1:2])
+        if not hasattr(self, args.command):
+            print('Unrecognized command', file=sys.stderr)
+            parser.print_help(file=sys.stderr)
+            exit(1)
+        getattr(self, args.command)(sys.argv[2:])
+
+    def lease(self, argv):
+        parser = argparse.ArgumentParser(description="Lease basecall server")
+        parser.add_argument("state", help="Lease state file")
+        parser.add_argument("servers", nargs="+", help="Basecall servers as port or host:port")
+        parser.add_argument("--weight", type=int, default=1, help="Weight of job, e.g. batch size")
+        parser.add_argument("--pid", type=int, default=None, help="Process ID of job, defaults to parent process")
+        parser.add_argument("--timeout", type=int, default=86400, help="Lease timeout in seconds")
+        args = parser.parse_args(argv)
+        lease = guppy_server_dispatcher(args.state, timeout=args.timeout).lease(args.servers, weight=args.weight, pid=args.pid)
+        print('\t'.join([lease['id'], lease['server']]))
+
+    def release(self, argv):
+        parser = argparse.ArgumentParser(description="Release basecall server")
+        parser.add_argument("state", help="Lease state file")
+        parser.add_argument("lease", help="Lease ID")
+        args = parser.parse_args(argv)
+        guppy_server_dispatcher(args.state).release(args.lease)
+
+    def status(self, argv):
+        parser = argparse.ArgumentParser(description="Active basecall server leases")
+        parser.add_argument("state", help="Lease state file")
+        parser.add_argument("--timeout", type=int, default=86400, help="Lease timeout in seconds")
+        args = parser.parse_args(argv)
+        for lease in guppy_server_dispatcher(args.state, timeout=args.timeout).status():
+            print('\t'.join([lease['server'], str(lease['weight']), lease['host'], str(lease['pid']), lease['id']]))
+
+
+
+
+if __name__ == '__main__':
+    main()
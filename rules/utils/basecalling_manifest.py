@@ -0,0 +1,200 @@
+# \HEADER\-------------------------------------------------------------------------
+#
+#  CONTENTS      : Sequence batch manifest
+#
+#  DESCRIPTION   : Virtual and zero-copy concatenation of batch fastq
+#
+#  RESTRICTIONS  : none
+#
+#  REQUIRES      : none
+#
+# ---------------------------------------------------------------------------------
+# Copyright (c) 2018-2021, Pay Giesselmann, Max Planck Institute for Molecular Genetics
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Written by Pay Giesselmann
+# ---------------------------------------------------------------------------------
+import os, sys
+import zlib
+import argparse
+from signal import signal, SIGPIPE, SIG_DFL
+
+
+
+
+# ordered list of gzip compressed batches, concatenated gzip members are a valid gzip file
+# one line per batch:
+#   path, size in bytes, number of reads
+class sequence_manifest():
+    suffix = '.manifest'
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.entries = []
+        with open(manifest_file, 'r') as fp:
+            for line in fp:
+                path, size, reads = line.rstrip('\n').split('\t')
+                self.entries.append((path, int(size), int(reads)))
+
+    # number of reads in gzip compressed fastq
+    def __count_reads__(path, chunk_size=1<<22):
+        lines = 0
+        with open(path, 'rb') as fp:
+            decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                while chunk:
+                    lines += decomp.decompress(chunk).count(b'\n')
+                    chunk = decomp.unused_data
+                    if chunk:
+                        decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return lines // 4
+
+    # copy in kernel space, fall back to user space copy if not supported
+    def __copy__(fd_in, fd_out, size):
+        offset = 0
+        for fn in [getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)]:
+            if fn is None:
+                continue
+            try:
+                while offset < size:
+                    if fn is os.sendfile:
+                        n = fn(fd_out, fd_in, offset, size - offset)
+                    else:
+                        n = fn(fd_in, fd_out, size - offset, offset_src=offset)
+                    if n == 0:
+                        break
+                    offset += n
+                return offset
+            except OSError:
+                continue
+        os.lseek(fd_in, offset, os.SEEK_SET)
+        while offset < size:
+            data = os.read(fd_in, min(1<<22, size - offset))
+            if not data:
+                break
+            os.write(fd_out, data)
+            offset += len(data)
+        return offset
+
+    def write(output, inputs):
+        # flatten nested manifests, e.g. tag from run level
+        entries = []
+        for path in inputs:
+            if path.endswith(sequence_manifest.suffix):
+                entries.extend(sequence_manifest(path).entries)
+            else:
+                entries.append((path, os.path.getsize(path), sequence_manifest.__count_reads__(path)))
+        with open(output + '.tmp', 'w') as fp:
+            for path, size, reads in entries:
+                print('\t'.join([path, str(size), str(reads)]), file=fp)
+        os.replace(output + '.tmp', output)
+
+    # batch files of manifests, other paths are passed through
+    def files(inputs):
+        files = []
+        for path in inputs:
+            if path.endswith(sequence_manifest.suffix):
+                for f, size, _ in sequence_manifest(path).entries:
+                    if os.path.getsize(f) != size:
+                        raise RuntimeError("[ERROR] Batch {} changed after writing manifest {}".format(f, path))
+                    files.append(f)
+            else:
+                files.append(path)
+        return files
+
+    # physical concatenation of batches to file or stdout
+    def cat(inputs, output=None):
+        files = sequence_manifest.files(inputs)
+        if output:
+            fd_out = os.open(output + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        else:
+            sys.stdout.flush()
+            fd_out = sys.stdout.fileno()
+        try:
+            for f in files:
+                fd_in = os.open(f, os.O_RDONLY)
+                try:
+                    sequence_manifest.__copy__(fd_in, fd_out, os.fstat(fd_in).st_size)
+                finally:
+                    os.close(fd_in)
+        finally:
+            if output:
+                os.close(fd_out)
+        if output:
+            os.replace(output + '.tmp', output)
+
+
+
+
+class main():
+    def __init__(self):
+        parser = argparse.ArgumentParser(
+        description='Sequence batch manifest',
+        usage='''basecalling_manifest.py <command> [<args>]
+Available commands are:
+   write      Write manifest of batches
+   files      Print batch files of manifests
+   cat        Concatenate batches of manifests
+''')
+        parser.add_argument('command', help='Subcommand to run')
+        args = parser.parse_args(sys.argv[1:2])
+        if not hasattr(self, args.command):
+            print('Unrecognized command', file=sys.stderr)
+            parser.print_help(file=sys.stderr)
+            exit(1)
+        getattr(self, args.command)(sys.argv[2:])
+
+    def write(self, argv):
+        parser = argparse.ArgumentParser(description="Write manifest of batches")
+        parser.add_argument("output", help="Output manifest")
+        parser.add_argument("inputs", nargs="+", help="Batch fastq.gz or manifest files")
+        args = parser.parse_args(argv)
+        sequence_manifest.write(args.output, args.inputs)
+
+    def files(self, argv):
+        parser = argparse.ArgumentParser(description="Print batch files of manifests")
+        parser.add_argument("inputs", nargs="+", help="Manifest or fastq.gz files")
+        args = parser.parse_args(argv)
+        try:
+            print(' '.join(sequence_manifest.files(args.inputs)))
+        except RuntimeError as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
+
+    def cat(self, argv):
+        parser = argparse.ArgumentParser(description="Concatenate batches of manifests")
+        parser.add_argument("inputs", nargs="+", help="Manifest or fastq.gz files")
+        parser.add_argument("--output", default=None, help="Output file, default stdout")
+        args = parser.parse_args(argv)
+        try:
+            sequence_manifest.cat(args.inputs, output=args.output)
+        except RuntimeError as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
+
+
+
+
+if __name__ == '__main__':
+    signal(SIGPIPE,SIG_DFL)
+    main()
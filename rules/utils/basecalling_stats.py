@@ -0,0 +1,175 @@
+# \HEADER\-------------------------------------------------------------------------
+#
+#  CONTENTS      : Basecalling statistics
+#
+#  DESCRIPTION   : none
+#
+#  RESTRICTIONS  : none
+#
+#  REQUIRES      : none
+#
+# ---------------------------------------------------------------------------------
+# Copyright (c) 2018-2021, Pay Giesselmann, Max Planck Institute for Molecular Genetics
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Written by Pay Giesselmann
+# ---------------------------------------------------------------------------------
+import os, sys, gzip
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+
+
+
+# split fastq stream into chunks of complete 4-line records
+def fastq_chunks(fp, chunk_size=1 << 23):
+    remainder = b''
+    while True:
+        chunk = fp.read(chunk_size)
+        lines = (remainder + chunk).split(b'\n')
+        if chunk:
+            remainder = lines.pop()
+        else:
+            while len(lines) and not lines[-1]:
+                lines.pop()
+        n = len(lines) // 4 * 4
+        if n:
+            yield lines[:n]
+        if chunk:
+            remainder = b'\n'.join(lines[n:] + [remainder])
+        else:
+            if n != len(lines):
+                raise ValueError("Truncated fastq record at end of input")
+            return
+
+
+
+
+# length and mean quality of records in chunk
+def chunk_stats(lines):
+    titles, sequences, qualities = lines[0::4], lines[1::4], lines[3::4]
+    if not all(title[:1] == b'@' for title in titles):
+        raise ValueError("Fastq record not starting with @")
+    length = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    q_length = np.fromiter(map(len, qualities), dtype=np.int64, count=len(qualities))
+    q_sum = np.concatenate(([0], np.cumsum(np.frombuffer(b''.join(qualities), dtype=np.uint8), dtype=np.int64)))
+    q_end = np.cumsum(q_length)
+    q_total = q_sum[q_end] - q_sum[q_end - q_length] - 33 * q_length
+    quality = np.divide(q_total, q_length, out=np.zeros(len(q_length), dtype=np.float64), where=q_length > 0)
+    return length, quality
+
+
+
+
+# length and mean quality of all reads in fastq file
+def fastq_stats(fastq_file, chunk_size=1 << 23):
+    lengths, qualities = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+    with (gzip.open(fastq_file, 'rb') if fastq_file.endswith('.gz') else open(fastq_file, 'rb')) as fp:
+        for lines in fastq_chunks(fp, chunk_size=chunk_size):
+            length, quality = chunk_stats(lines)
+            lengths.append(length)
+            qualities.append(quality)
+    return np.concatenate(lengths), np.concatenate(qualities)
+
+
+
+
+# columns and types of guppy sequencing summary
+summary_columns = {'read_id': str, 'channel': np.int32, 'start_time': np.float64, 'duration': np.float32,
+                   'passes_filtering': bool, 'sequence_length_template': np.int64, 'mean_qscore_template': np.float32}
+
+
+
+
+class basecalling_stats():
+    def __init__(self):
+        parser = argparse.ArgumentParser(
+        description='Nanopore basecalling statistics',
+        usage='''basecalling_stats.py <command> [<args>]
+Available commands are:
+   fastq      Read length and quality from fastq files
+   merge      Merge guppy sequencing summaries into run summary
+   summary    Read length and quality from run summary
+''')
+        parser.add_argument('command', help='Subcommand to run')
+        args = parser.parse_args(sys.argv[1:2])
+        if not hasattr(self, args.command):
+            print('Unrecognized command', file=sys.stderr)
+            parser.print_help(file=sys.stderr)
+            exit(1)
+        getattr(self, args.command)(sys.argv[2:])
+
+    def fastq(self, argv):
+        parser = argparse.ArgumentParser(description="Compute summary from basecalling")
+        parser.add_argument("output", help="output file")
+        parser.add_argument("input", nargs="*", help="input fastq files")
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+        args = parser.parse_args(argv)
+        if args.processes > 1 and len(args.input) > 1:
+            with multiprocessing.Pool(args.processes) as pool:
+                stats = list(pool.imap(fastq_stats, args.input))
+        else:
+            stats = [fastq_stats(f) for f in args.input]
+        df = pd.DataFrame({'length': np.concatenate([np.zeros(0, dtype=np.int64)] + [s[0] for s in stats]),
+                           'quality': np.concatenate([np.zeros(0, dtype=np.float64)] + [s[1] for s in stats])})
+        df.to_hdf(args.output, key='stats')
+
+    def merge(self, argv):
+        parser = argparse.ArgumentParser(description="Merge guppy sequencing summaries")
+        parser.add_argument("output", help="output file")
+        parser.add_argument("input", nargs="*", help="input sequencing summary files")
+        parser.add_argument("--chunk_size", type=int, default=100000, help="Number of lines parsed at once")
+        args = parser.parse_args(argv)
+        with pd.HDFStore(args.output + '.tmp', 'w', complevel=1, complib='blosc') as store:
+            for f in args.input:
+                if not os.path.getsize(f):
+                    continue
+                for df in pd.read_csv(f, sep='\t', chunksize=args.chunk_size,
+                        usecols=lambda column: column in summary_columns, dtype=summary_columns):
+                    store.append('summary', df[[c for c in summary_columns if c in df.columns]],
+                        format='table', index=False, min_itemsize={'read_id': 36})
+        os.replace(args.output + '.tmp', args.output)
+
+    def summary(self, argv):
+        parser = argparse.ArgumentParser(description="Compute summary from run sequencing summary")
+        parser.add_argument("output", help="output file")
+        parser.add_argument("input", help="input run summary")
+        parser.add_argument("--pass_only", action="store_true", help="Only use reads passing the quality filter")
+        parser.add_argument("--chunk_size", type=int, default=1000000, help="Number of reads loaded at once")
+        args = parser.parse_args(argv)
+        df_list = []
+        with pd.HDFStore(args.input, 'r') as store:
+            if 'summary' in store:
+                for df in store.select('summary', chunksize=args.chunk_size):
+                    if args.pass_only and 'passes_filtering' in df.columns:
+                        df = df[df.passes_filtering]
+                    df_list.append(pd.DataFrame({'length': df.sequence_length_template.values.astype(np.int64),
+                        'quality': df.mean_qscore_template.values.astype(np.float64)}).assign(
+                        **{c:df[c].values for c in ['channel', 'start_time', 'duration'] if c in df.columns}))
+        df = pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame({'length': np.zeros(0, dtype=np.int64), 'quality': np.zeros(0, dtype=np.float64)})
+        df.to_hdf(args.output, key='stats')
+
+
+
+
+if __name__ == '__main__':
+    basecalling_stats()
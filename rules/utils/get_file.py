@@ -80,6 +80,21 @@ def get_signal_batch(wildcards, config):
         return []
 
 
+# extraction cache flags for storage_fast5Index.py extract
+def get_signal_cache(config):
+    if config.get('storage_extract_cache'):
+        return '--cache_dir {cache_dir} --cache_size {cache_size}'.format(
+            cache_dir=config['storage_extract_cache'],
+            cache_size=config.get('storage_extract_cache_size') or 100)
+    else:
+        return ''
+
+
+# merged run sequences or manifest of batches
+def get_sequence_ext(config):
+    return '.fastq.manifest' if config.get('basecalling_merge_manifest') else '.fastq.gz'
+
+
 # get available batch sequence
 def get_sequence_batch(wildcards, config):
     base = "sequences/{sequence_workflow}/batches/{tag}/{runname}/{batch}".format(
@@ -95,7 +110,7 @@ def get_sequence_run(wildcards, config):
             sequence_workflow=wildcards.sequence_workflow,
             tag=wildcards.tag,
             runname=wildcards.runname)
-    return base + '.fastq.gz'
+    return base + get_sequence_ext(config)
 
 
 def get_sequence_runs(wildcards, config):
@@ -106,7 +121,7 @@ def get_sequence_runs(wildcards, config):
                 sequence_workflow=wildcards.sequence_workflow,
                 tag=wildcards.tag,
                 runname=run)
-        sequences.append(base + '.fastq.gz')
+        sequences.append(base + get_sequence_ext(config))
     return sequences
 
 
@@ -31,91 +31,482 @@
 #
 # Written by Pay Giesselmann
 # ---------------------------------------------------------------------------------
-import os, sys, re, argparse
-import itertools
-import shutil
-import tempfile, tarfile
+import os, sys, io, re, glob, argparse
+import itertools, functools
+import shutil, mmap, struct, uuid, array
+import json, hashlib
+import time, errno, fcntl
+import tarfile
+import multiprocessing
+from collections import OrderedDict
 import h5py
-from ont_fast5_api.fast5_interface import is_multi_read
+import numpy as np
 from ont_fast5_api.fast5_file import Fast5File
 from ont_fast5_api.multi_fast5 import MultiFast5File
-from ont_fast5_api.conversion_tools import multi_to_single_fast5, single_to_multi_fast5
+from ont_fast5_api.compression_settings import VBZ, GZIP, register_plugin
+from ont_fast5_api.conversion_tools import multi_to_single_fast5
+
+
+# vbz filter for direct h5py access to repacked batches
+register_plugin()
+
+
+# memory mapped binary read index
+# layout (little endian):
+#   header      magic, version, n_reads, n_strings
+#   ids         n_reads x 16 byte read UUID, sorted
+#   records     n_reads x (batch, member) uint32 index into string table
+#               and (offset, size) uint64 of tar member data (version 2)
+#   offsets     (n_strings + 1) x uint64 offset into string blob
+#   strings     utf-8 encoded batch and member names
+class binary_index():
+    magic = b'NPIDX\x00\x00\x00'
+    version = 2
+    header = struct.Struct('<8sIIQQ')
+    record_dtypes = {
+        1: np.dtype([('batch', '<u4'), ('member', '<u4')]),
+        2: np.dtype([('batch', '<u4'), ('member', '<u4'), ('offset', '<u8'), ('size', '<u8')])}
+    # member of multi read fast5 is derived from read ID
+    member_from_ID = np.iinfo(np.uint32).max
+    no_member = np.iinfo(np.uint32).max - 1
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, n_reads, n_strings = binary_index.header.unpack_from(self.mm, 0)
+        if magic != binary_index.magic or version not in binary_index.record_dtypes:
+            raise RuntimeError("[Error] {} is not a binary read index of version {}.".format(index_file, binary_index.version))
+        offset = binary_index.header.size
+        self.ids = np.frombuffer(self.mm, dtype='S16', count=n_reads, offset=offset)
+        offset += self.ids.nbytes
+        self.records = np.frombuffer(self.mm, dtype=binary_index.record_dtypes[version], count=n_reads, offset=offset)
+        offset += self.records.nbytes
+        self.string_offsets = np.frombuffer(self.mm, dtype='<u8', count=n_strings + 1, offset=offset)
+        self.string_base = offset + self.string_offsets.nbytes
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __contains__(self, ID):
+        return ID in self.lookup([ID])
+
+    def __getitem__(self, ID):
+        paths = self.lookup([ID])
+        if ID not in paths:
+            raise KeyError(ID)
+        return paths[ID]
+
+    def __string__(self, i):
+        begin, end = self.string_offsets[i], self.string_offsets[i + 1]
+        return self.mm[self.string_base + begin : self.string_base + end].decode('utf-8')
+
+    def __uuid__(ID):
+        try:
+            return uuid.UUID(ID).bytes
+        except ValueError:
+            return None
+
+    # binary search of read IDs, returns dict of ID to record for found IDs
+    def __search__(self, IDs):
+        IDs = [(ID, binary_index.__uuid__(ID)) for ID in IDs]
+        IDs = [(ID, b) for ID, b in IDs if b]
+        if not IDs or not len(self):
+            return {}
+        query = np.array([b for _, b in IDs], dtype='S16')
+        IDs = [ID for ID, _ in IDs]
+        pos = np.minimum(np.searchsorted(self.ids, query), len(self) - 1)
+        found = self.ids[pos] == query
+        return {ID:self.records[i] for ID, i in zip(itertools.compress(IDs, found), pos[found])}
+
+    # returns dict of ID to (batch, member, offset, size) for found IDs,
+    # member is None for single fast5 and offset/size are None if unknown
+    def locate(self, IDs):
+        locations = {}
+        for ID, record in self.__search__(IDs).items():
+            batch, member = self.__string__(record['batch']), record['member']
+            if member == binary_index.member_from_ID:
+                member = 'read_' + ID
+            elif member == binary_index.no_member:
+                member = None
+            else:
+                member = self.__string__(member)
+            if 'size' in record.dtype.names and record['size'] > 0:
+                locations[ID] = (batch, member, int(record['offset']), int(record['size']))
+            else:
+                locations[ID] = (batch, member, None, None)
+        return locations
+
+    # returns dict of ID to path for found IDs
+    def lookup(self, IDs):
+        return {ID:'/'.join([batch, member]) if member else batch
+                    for ID, (batch, member, _, _) in self.locate(IDs).items()}
+
+    # write index from iterable of (path, ID) or (path, ID, offset, size)
+    def write(output, records):
+        strings = {}
+        ids = bytearray()
+        batches, members = array.array('I'), array.array('I')
+        offsets, sizes = array.array('Q'), array.array('Q')
+        for record in records:
+            path, ID = record[:2]
+            offset, size = record[2:4] if len(record) >= 4 else (0, 0)
+            batch, _, member = binary_index.__split__(path)
+            b = strings.setdefault(batch, len(strings))
+            if not member:
+                m = binary_index.no_member
+            elif member == 'read_' + ID:
+                m = binary_index.member_from_ID
+            else:
+                m = strings.setdefault(member, len(strings))
+            ID_bytes = binary_index.__uuid__(ID)
+            if not ID_bytes:
+                raise RuntimeError("[Error] Read ID {} is not a valid UUID.".format(ID))
+            ids.extend(ID_bytes)
+            batches.append(b)
+            members.append(m)
+            offsets.append(int(offset))
+            sizes.append(int(size))
+        ids = np.frombuffer(bytes(ids), dtype='S16')
+        records = np.empty(ids.shape[0], dtype=binary_index.record_dtypes[binary_index.version])
+        records['batch'] = np.frombuffer(batches, dtype=np.uint32)
+        records['member'] = np.frombuffer(members, dtype=np.uint32)
+        records['offset'] = np.frombuffer(offsets, dtype=np.uint64)
+        records['size'] = np.frombuffer(sizes, dtype=np.uint64)
+        # sort by ID, duplicated IDs resolve to the last occurrence
+        order = np.argsort(ids, kind='stable')
+        ids, records = ids[order], records[order]
+        if ids.shape[0]:
+            unique = np.append(ids[1:] != ids[:-1], True)
+            ids, records = ids[unique], records[unique]
+        string_blobs = [s.encode('utf-8') for s, _ in sorted(strings.items(), key=lambda x : x[1])]
+        string_offsets = np.cumsum([0] + [len(s) for s in string_blobs], dtype='<u8')
+        with open(output + '.tmp', 'wb') as fp:
+            fp.write(binary_index.header.pack(binary_index.magic, binary_index.version, 0, ids.shape[0], len(string_blobs)))
+            fp.write(ids.tobytes())
+            fp.write(records.tobytes())
+            fp.write(string_offsets.tobytes())
+            for s in string_blobs:
+                fp.write(s)
+        os.replace(output + '.tmp', output)
+
+    # split path into batch file and optional member
+    def __split__(path):
+        fields = re.split('(\.fast5|\.tar)\/', path, maxsplit=1)
+        if len(fields) == 3:
+            return fields[0] + fields[1], fields[1], fields[2]
+        else:
+            return path, '', ''
+
+
+
+
+# least recently used cache of open fast5 handles and tar member buffers
+class fast5_cache():
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __close__(value):
+        if hasattr(value, 'close'):
+            value.close()
+
+    def get(self, key, open_fn):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = open_fn()
+        self.entries[key] = value
+        while len(self.entries) > max(1, self.max_size):
+            _, evicted = self.entries.popitem(last=False)
+            fast5_cache.__close__(evicted)
+        return value
+
+    def clear(self):
+        while self.entries:
+            _, value = self.entries.popitem(last=False)
+            fast5_cache.__close__(value)
+
+
 
 
 class fast5_Index():
-    def __init__(self, index_file=None, tmp_prefix=None):
+    qc_columns = [('read_id', 'S36'), ('n_samples', np.uint64), ('median', np.float32),
+                  ('mad', np.float32), ('start_time', np.float64), ('duration', np.float32)]
+
+    def __init__(self, index_file=None, cache_size=16):
         self.index_file = index_file
-        self.tmp_prefix = tmp_prefix
+        self.cache = fast5_cache(cache_size)
         if index_file and not os.path.exists(index_file):
             raise RuntimeError("[Error] Raw fast5 index file {} not found.".format(index_file))
         elif index_file:
-            with open(index_file, 'r') as fp:
-                self.index_dict = {id:path for path,id in [line.split('\t') for line in fp.read().split('\n') if line]}
+            # prefer memory mapped binary index next to text index if up to date
+            binary_index_file = os.path.splitext(index_file)[0] + '.idx'
+            if index_file.endswith('.idx'):
+                self.read_index = binary_index(index_file)
+            elif os.path.isfile(binary_index_file) and os.path.getmtime(binary_index_file) >= os.path.getmtime(index_file):
+                self.read_index = binary_index(binary_index_file)
+            else:
+                with open(index_file, 'r') as fp:
+                    self.read_index = {id:path for path,id in [line.split('\t')[:2] for line in fp.read().split('\n') if line]}
+        else:
+            self.read_index = None
+
+    # batch, member and tar member offset and size of read IDs present in index
+    def __locate__(self, read_ids):
+        if isinstance(self.read_index, binary_index):
+            return self.read_index.locate(read_ids)
+        else:
+            locations = {}
+            for id in [id for id in read_ids if id in self.read_index]:
+                batch, _, member = binary_index.__split__(self.read_index[id])
+                locations[id] = (batch, member or None, None, None)
+            return locations
+
+    def __decode_ID__(ID):
+        return str(ID, 'utf-8') if isinstance(ID, bytes) else str(ID)
+
+    # read ID of read group, try known layout first and fall back to full visit
+    def __get_group_ID__(raw_group):
+        if 'read_id' in raw_group.attrs:
+            return fast5_Index.__decode_ID__(raw_group.attrs['read_id'])
+        if 'Reads' in raw_group:
+            for read in raw_group['Reads'].values():
+                if 'read_id' in read.attrs:
+                    return fast5_Index.__decode_ID__(read.attrs['read_id'])
+        s = raw_group.visit(lambda name: name if 'Signal' in name else None)
+        return fast5_Index.__decode_ID__(raw_group[s.rpartition('/')[0]].attrs['read_id'])
+
+    # signal metrics of a read in pA and seconds
+    def __get_group_QC__(raw_group, channel):
+        if 'Signal' not in raw_group:
+            raw_group = next(iter(raw_group['Reads'].values()))
+        signal = raw_group['Signal'][...].astype(np.float32)
+        scale = float(channel.attrs['range']) / float(channel.attrs['digitisation'])
+        sampling_rate = float(channel.attrs['sampling_rate'])
+        if len(signal):
+            median = np.median(signal)
+            mad = np.median(np.abs(signal - median))
+        else:
+            median = mad = np.nan
+        return (len(signal), (median + float(channel.attrs['offset'])) * scale, mad * scale,
+                raw_group.attrs['start_time'] / sampling_rate, raw_group.attrs['duration'] / sampling_rate)
+
+    # write signal metrics as columns of hdf5 file
+    def __write_QC__(output, metrics):
+        with h5py.File(output + '.tmp', 'w') as f5:
+            for column, dtype in fast5_Index.qc_columns:
+                data = np.array([m[column] for m in metrics] if isinstance(metrics, list) else metrics[column], dtype=dtype)
+                f5.create_dataset(column, data=data, compression='gzip', shuffle=True, chunks=True if len(data) else None)
+        os.replace(output + '.tmp', output)
+
+    # open fast5 on disk or tar member from its data offset and size in memory
+    def __open__(f5_file, member=None):
+        if member is None:
+            return h5py.File(f5_file, 'r')
+        elif isinstance(member, bytes):
+            return h5py.File(io.BytesIO(member), 'r')
         else:
-            self.index_dict = None
-
-    def __chunked__(l, n):
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
-
-    def __get_ID_single__(f5_file):
-        with h5py.File(f5_file, 'r') as f5:
-            s = f5["/Raw/"].visit(lambda name: name if 'Signal' in name else None)
-            return str(f5["/Raw/" + s.rpartition('/')[0]].attrs['read_id'], 'utf-8')
-
-    def __get_ID_multi__(f5_file):
-        with h5py.File(f5_file, 'r') as f5:
-            reads = []
-            for group in f5:
-                s = f5[group + "/Raw/"].visit(lambda name: name if 'Signal' in name else None)
-                ID = (str(f5[group + "/Raw/" + s.rpartition('/')[0]].attrs['read_id'], 'utf-8'))
-                reads.append((group, ID))
-        return reads
+            offset, size = member
+            with open(f5_file, 'rb') as fp:
+                fp.seek(offset)
+                return h5py.File(io.BytesIO(fp.read(size)), 'r')
+
+    # split fast5 into tasks of single file or chunks of read groups
+    def __tasks__(f5_file, f5_relative, processes=1):
+        try:
+            with h5py.File(f5_file, 'r') as f5:
+                if 'Raw' in f5:
+                    return [(f5_file, f5_relative, None, None)]
+                groups = list(f5.keys())
+        except:
+            print("[ERROR] Failed to open {f5}, skip file for indexing".format(f5=f5_file), file=sys.stderr)
+            return []
+        n = max(1, -(-len(groups) // (processes * 4)))
+        return [(f5_file, f5_relative, groups[i:i + n], None) for i in range(0, len(groups), n)]
+
+    # split tar archive into tasks of single read members
+    def __tar_tasks__(tar_file, tar_relative, processes=1):
+        tasks = []
+        try:
+            # uncompressed archives are read from member offsets by the workers
+            with tarfile.open(tar_file, 'r:') as fp_tar:
+                for tar_member in fp_tar:
+                    if tar_member.isfile() and tar_member.name.endswith('.fast5'):
+                        tasks.append((tar_file, os.path.normpath(os.path.join(tar_relative, tar_member.name)), None, (tar_member.offset_data, tar_member.size)))
+        except tarfile.ReadError:
+            # compressed archives are streamed by each worker for its chunk of member names
+            with tarfile.open(tar_file) as fp_tar:
+                names = sorted(tar_member.name for tar_member in fp_tar if tar_member.isfile() and tar_member.name.endswith('.fast5'))
+            n = max(1, -(-len(names) // processes))
+            return [(tar_file, tar_relative, names[i:i + n], 'compressed') for i in range(0, len(names), n)]
+        tasks.sort(key=lambda x : x[1])
+        return tasks
+
+    # index chunk of members of compressed tar archive
+    def __scan_compressed__(task, qc=False):
+        tar_file, tar_relative, names, _ = task
+        names = set(names)
+        results = []
+        with tarfile.open(tar_file) as fp_tar:
+            for tar_member in fp_tar:
+                if tar_member.isfile() and tar_member.name in names:
+                    results.append(fast5_Index.__scan__((tar_file, os.path.normpath(os.path.join(tar_relative, tar_member.name)), None, fp_tar.extractfile(tar_member).read()), qc=qc))
+        results.sort(key=lambda x : x[0][0][0] if x[0] else '')
+        return [r for records, _ in results for r in records], [m for _, metrics in results for m in metrics]
+
+    # index records of single fast5 or read groups of multi read fast5, run in worker processes
+    # with qc, signal metrics of every read are returned along with the records
+    def __scan__(task, qc=False):
+        f5_file, f5_relative, groups, member = task
+        if member == 'compressed':
+            return fast5_Index.__scan_compressed__(task, qc=qc)
+        try:
+            with fast5_Index.__open__(f5_file, member) as f5:
+                if groups is None:
+                    records = [(f5_relative, fast5_Index.__get_group_ID__(f5['/Raw/']))]
+                    if isinstance(member, tuple):
+                        records = [records[0] + member]
+                    raw_channels = [(f5['/Raw/'], f5['/UniqueGlobalKey/channel_id'])] if qc else []
+                else:
+                    records = [(os.path.join(f5_relative, group), fast5_Index.__get_group_ID__(f5[group + "/Raw/"])) for group in groups]
+                    raw_channels = [(f5[group + "/Raw/"], f5[group + "/channel_id"]) for group in groups] if qc else []
+                metrics = [(record[1],) + fast5_Index.__get_group_QC__(raw_group, channel) for record, (raw_group, channel) in zip(records, raw_channels)]
+                return records, metrics
+        except:
+            print("[ERROR] Failed to open {f5}, skip file for indexing".format(f5=f5_relative), file=sys.stderr)
+            return [], []
+
+    # located reads sorted by batch and position within batch
+    def __locations__(self, read_ids):
+        return sorted([(batch, member, offset, size, id) for id, (batch, member, offset, size) in self.__locate__(read_ids).items()],
+                      key=lambda x : (x[0], x[2] or 0, x[1] or ''))
+
+    # iterate single reads of a tar archive as in memory fast5 files
+    def __iter_tar__(tar_file, members=None):
+        with tarfile.open(tar_file) as fp_tar:
+            for tar_member in fp_tar:
+                if tar_member.isfile() and tar_member.name.endswith('.fast5') and (members is None or os.path.normpath(tar_member.name) in members):
+                    try:
+                        with Fast5File(io.BytesIO(fp_tar.extractfile(tar_member).read()), 'r') as f5:
+                            yield f5
+                    except Exception:
+                        print('[ERROR] Could not extract {id} from {batch}.'.format(id=tar_member.name, batch=tar_file), file=sys.stderr)
+
+    # iterate located reads as ont_fast5_api reads, batch files are opened once
+    def __iter_reads__(self, locations):
+        for batch, batch_locations in itertools.groupby(locations, key=lambda x : x[0]):
+            batch_locations = list(batch_locations)
+            batch_file = os.path.join(os.path.dirname(self.index_file), batch)
+            if batch_locations[0][1] is None:
+                # single read fast5
+                with Fast5File(batch_file, 'r') as f5:
+                    yield f5
+            elif batch.endswith('.tar'):
+                if all(size for _, _, _, size, _ in batch_locations):
+                    # read member data from indexed offsets
+                    with open(batch_file, 'rb') as fp_tar:
+                        for _, member, offset, size, _ in batch_locations:
+                            fp_tar.seek(offset)
+                            with Fast5File(io.BytesIO(fp_tar.read(size)), 'r') as f5:
+                                yield f5
+                else:
+                    yield from fast5_Index.__iter_tar__(batch_file, set(member for _, member, _, _, _ in batch_locations))
+            elif batch.endswith('.fast5'):
+                with MultiFast5File(batch_file, 'r') as multi_f5:
+                    for _, _, _, _, read_id in batch_locations:
+                        try:
+                            yield multi_f5.get_read(read_id)
+                        except KeyError:
+                            print('[ERROR] Could not extract {id} from {batch}.'.format(id=read_id, batch=batch_file), file=sys.stderr)
+
+    # copy reads into bulk fast5 files of batch_size reads by HDF5 group copy
+    def __write_bulk__(reads, output_prefix, n_reads, batch_size=4000, target_compression=None):
+        multi_f5 = None
+        try:
+            for i, read in enumerate(reads):
+                if i % batch_size == 0:
+                    if multi_f5:
+                        multi_f5.close()
+                    if n_reads > batch_size:
+                        output_bulk_file = output_prefix + '_{i}.fast5'.format(i=i // batch_size)
+                    else:
+                        output_bulk_file = output_prefix + '.fast5'
+                    multi_f5 = MultiFast5File(output_bulk_file, 'w')
+                multi_f5.add_existing_read(read, target_compression=target_compression)
+        finally:
+            if multi_f5:
+                multi_f5.close()
+
+    # convert tar archive of single reads into compressed bulk-fast5 and verify read IDs
+    def __repack__(task):
+        tar_file, compression = task
+        batch_name = os.path.splitext(tar_file)[0]
+        tar_ids = []
+        def reads():
+            for f5 in fast5_Index.__iter_tar__(tar_file):
+                tar_ids.append(f5.read_id)
+                yield f5
+        with tarfile.open(tar_file) as fp_tar:
+            n_members = sum(1 for tar_member in fp_tar if tar_member.isfile() and tar_member.name.endswith('.fast5'))
+        if n_members == 0:
+            print("[WARNING] No reads in {batch}, archive is kept.".format(batch=tar_file), file=sys.stderr)
+            return tar_file, None
+        fast5_Index.__write_bulk__(reads(), batch_name + '.repack', n_members,
+            batch_size=max(1, n_members), target_compression={'vbz':VBZ, 'gzip':GZIP}[compression])
+        with MultiFast5File(batch_name + '.repack.fast5', 'r') as f5:
+            bulk_ids = f5.get_read_ids()
+        if len(tar_ids) != n_members or sorted(tar_ids) != sorted(bulk_ids):
+            os.remove(batch_name + '.repack.fast5')
+            raise RuntimeError("[ERROR] Repacked {batch} contains {n_bulk} of {n_tar} reads.".format(batch=tar_file, n_bulk=len(bulk_ids), n_tar=n_members))
+        os.replace(batch_name + '.repack.fast5', batch_name + '.fast5')
+        return tar_file, bulk_ids
 
     def __copy_reads_to__(self, read_ids, output):
         if not os.path.exists(output):
             os.makedirs(output)
-        batch_id_files = [tuple( [id] + re.split('(\.fast5|\.tar)\/', self.index_dict[id]) ) for id in read_ids if id in self.index_dict]
-        batch_id_files.sort(key=lambda x : (x[1], x[2]) if len(x) > 2 else x[1])
-        for _, id_batch_paths in itertools.groupby(batch_id_files, key=lambda x : (x[1], x[2]) if len(x) > 2 else x[1]):
-            fofns = list(id_batch_paths)
-            if len(fofns) == 1 and len(fofns[0]) == 2:
+        locations = self.__locations__(read_ids)
+        for batch, batch_locations in itertools.groupby(locations, key=lambda x : x[0]):
+            batch_locations = list(batch_locations)
+            batch_file = os.path.join(os.path.dirname(self.index_file), batch)
+            if batch_locations[0][1] is None:
                 # single read fast5
-                id, src_file = fofns[0]
-                shutil.copy(os.path.join(os.path.dirname(args.index), src_file), output)
-            else:
-                _, batch_file, batch_ext, _ = fofns[0]
-                tarFiles = set([x[3] for x in fofns])
-                # single read fast5 batch in tar archive
-                if batch_ext == '.tar':
-                    tar_file = os.path.join(os.path.dirname(self.index_file), batch_file + batch_ext)
-                    with tarfile.open(tar_file) as fp_tar:
-                        tar_members = fp_tar.getmembers()
-                        for tar_member in tar_members:
-                            if any(s in tar_member.name for s in tarFiles):
+                shutil.copy(batch_file, output)
+            # single read fast5 batch in tar archive
+            elif batch.endswith('.tar'):
+                if all(size for _, _, _, size, _ in batch_locations):
+                    # copy member data from indexed offsets
+                    with open(batch_file, 'rb') as fp_tar:
+                        for _, member, offset, size, _ in batch_locations:
+                            fp_tar.seek(offset)
+                            with open(os.path.join(output, os.path.basename(member)), 'wb') as fp:
+                                fp.write(fp_tar.read(size))
+                else:
+                    tar_members = set(member for _, member, _, _, _ in batch_locations)
+                    with tarfile.open(batch_file) as fp_tar:
+                        for tar_member in fp_tar:
+                            if os.path.normpath(tar_member.name) in tar_members:
                                 try:
                                     tar_member.name = os.path.basename(tar_member.name)
                                     fp_tar.extract(tar_member, path=output)
                                 except:
-                                    RuntimeError('[ERROR] Could not extract {id} from {batch}.'.format(id=tar_member.name, batch=tar_file))
-                elif batch_ext == '.fast5':
-                    f5_file = os.path.join(os.path.dirname(self.index_file), batch_file + batch_ext)
-                    with MultiFast5File(f5_file, 'r') as multi_f5:
-                        target_ids = set([x[0] for x in fofns])
-                        for read_id in multi_f5.get_read_ids():
-                            if read_id in target_ids:
-                                try:
-                                    read = multi_f5.get_read(read_id)
-                                    output_file = os.path.join(output, "{}.fast5".format(read_id))
-                                    multi_to_single_fast5.create_single_f5(output_file, read)
-                                except:
-                                    RuntimeError('[ERROR] Could not extract {id} from {batch}.'.format(id=read_id, batch=f5_file))
-                else:
-                    pass
+                                    print('[ERROR] Could not extract {id} from {batch}.'.format(id=tar_member.name, batch=batch_file), file=sys.stderr)
+            elif batch.endswith('.fast5'):
+                with MultiFast5File(batch_file, 'r') as multi_f5:
+                    target_ids = set([id for _, _, _, _, id in batch_locations])
+                    for read_id in multi_f5.get_read_ids():
+                        if read_id in target_ids:
+                            try:
+                                read = multi_f5.get_read(read_id)
+                                output_file = os.path.join(output, "{}.fast5".format(read_id))
+                                multi_to_single_fast5.create_single_f5(output_file, read)
+                            except:
+                                print('[ERROR] Could not extract {id} from {batch}.'.format(id=read_id, batch=batch_file), file=sys.stderr)
 
-    def index(input, recursive=False, output_prefix="", tmp_prefix=None):
-        if tmp_prefix and not os.path.exists(tmp_prefix):
-            os.makedirs(tmp_prefix)
+    def index(input, recursive=False, output_prefix="", processes=1, tar_offsets=False, qc_output=None):
         input_files = []
         # scan input
         if os.path.isfile(input):
@@ -126,35 +517,31 @@ class fast5_Index():
             else:
                 input_files.extend(glob.glob(os.path.join(input, '*.fast5')))
                 input_files.extend(glob.glob(os.path.join(input, '*.tar')))
-        # index all provided files
-        for input_file in input_files:
-            input_relative = os.path.normpath(os.path.join(output_prefix,
-                             os.path.dirname(os.path.relpath(input_file, start=input)),
-                             os.path.basename(input_file)))
-            # extract reads from packed tar archive and retrieve read IDs
-            if input_file.endswith('.tar'):
-                with tempfile.TemporaryDirectory(prefix=tmp_prefix) as tmpdirname, tarfile.open(input_file) as fp_tar:
-                    fp_tar.extractall(path=tmpdirname)
-                    f5files = [os.path.join(dirpath, f) for dirpath, _, files in os.walk(tmpdirname) for f in files if f.endswith('.fast5')]
-                    for f5file in f5files:
-                        try:
-                            ID = fast5_Index.__get_ID_single__(f5file)
-                            print("\t".join([os.path.normpath(os.path.join(input_relative,
-                                             os.path.relpath(f5file, start=tmpdirname))), ID]))
-                        except:
-                            print("[ERROR] Failed to open {f5}, skip file for indexing".format(f5=f5file), file=sys.stderr)
-            # bulk and single read fast5
-            else:
-                if is_multi_read(input_file):
-                    reads = fast5_Index.__get_ID_multi__(input_file)
-                    for f, (group, ID) in zip([input_relative] * len(reads), reads):
-                        yield '\t'.join((os.path.join(f,group), ID))
-                else:
-                    try:
-                        ID = fast5_Index.__get_ID_single__(input_relative)
-                    except:
-                        print("[ERROR] Failed to open {f5}, skip file for indexing".format(f5=input_file), file=sys.stderr)
-                    yield '\t'.join([input_relative, ID])
+        input_files.sort()
+        def relative(input_file):
+            return os.path.normpath(os.path.join(output_prefix,
+                   os.path.dirname(os.path.relpath(input_file, start=input)),
+                   os.path.basename(input_file)))
+        # tar archives are streamed per member, bulk fast5 split into chunks of read groups
+        tasks = [task for input_file in input_files for task in
+                    (fast5_Index.__tar_tasks__(input_file, relative(input_file), processes) if input_file.endswith('.tar') else
+                     fast5_Index.__tasks__(input_file, relative(input_file), processes))]
+        # records are yielded in order of input files and tasks
+        scan = functools.partial(fast5_Index.__scan__, qc=qc_output is not None)
+        qc_metrics = []
+        if processes > 1:
+            with multiprocessing.Pool(processes) as pool:
+                for records, metrics in pool.imap(scan, tasks, chunksize=max(1, len(tasks) // (processes * 4))):
+                    qc_metrics.extend(metrics)
+                    for record in records:
+                        yield '\t'.join([str(x) for x in (record if tar_offsets else record[:2])])
+        else:
+            for records, metrics in map(scan, tasks):
+                qc_metrics.extend(metrics)
+                for record in records:
+                    yield '\t'.join([str(x) for x in (record if tar_offsets else record[:2])])
+        if qc_output is not None:
+            fast5_Index.__write_QC__(qc_output, [dict(zip([c for c, _ in fast5_Index.qc_columns], m)) for m in qc_metrics])
 
     def extract(self, input, output, format='single'):
         if not os.path.exists(output):
@@ -166,12 +553,10 @@ class fast5_Index():
                 with tarfile.open(input) as fp_tar:
                     fp_tar.extractall(path=output)
             else:
-                with tempfile.TemporaryDirectory(prefix=self.tmp_prefix) as tmpdirname, tarfile.open(input) as fp_tar:
-                    fp_tar.extractall(path=tmpdirname)
-                    f5files = [os.path.join(dirpath, f) for dirpath, _, files in os.walk(tmpdirname) for f in files if f.endswith('.fast5')]
-                    output_bulk_file = os.path.join(output, os.path.basename(batch_name) + '.fast5')
-                    #single_to_multi_fast5.create_multi_read_file(f5files, output_bulk_file)
-                    single_to_multi_fast5.create_multi_read_file(f5files, output_bulk_file, 'gzip')
+                with tarfile.open(input) as fp_tar:
+                    n_reads = sum(1 for tar_member in fp_tar if tar_member.isfile() and tar_member.name.endswith('.fast5'))
+                fast5_Index.__write_bulk__(fast5_Index.__iter_tar__(input),
+                    os.path.join(output, os.path.basename(batch_name)), n_reads, batch_size=max(1, n_reads))
         # bulk fast5
         elif batch_ext == '.fast5':
             if format in ['bulk', 'lazy']:
@@ -181,28 +566,317 @@ class fast5_Index():
         # read IDs to be extracted
         elif batch_ext == '.txt':
             # load index and requested IDs
-            if not self.index_dict :
+            if self.read_index is None:
                 raise RuntimeError("[Error] Extraction of reads from IDs without index file provided.")
             with open(input, 'r') as fp:
                 batch_ids = [id.strip() for id in fp.read().split('\n') if id]
             if format in ['single', 'lazy']:
                 self.__copy_reads_to__(batch_ids, output)
             else:
-                with tempfile.TemporaryDirectory(prefix=self.tmp_prefix) as tmpdirname:
-                    self.__copy_reads_to__(batch_ids, tmpdirname)
-                    f5files = [os.path.join(dirpath, f) for dirpath, _, files in os.walk(tmpdirname) for f in files if f.endswith('.fast5')]
-                    if len(f5files) > 4000:
-                        for i, f5_batch in enumerate(fast5_Index.__chunked__(f5files, 4000)):
-                            output_bulk_file = os.path.join(output, os.path.basename(batch_name) + '_{i}.fast5'.format(i=i))
-                            single_to_multi_fast5.create_multi_read_file(f5_batch, output_bulk_file, None)
-                    else:
-                        output_bulk_file = os.path.join(output, os.path.basename(batch_name) + '.fast5')
-                        single_to_multi_fast5.create_multi_read_file(f5files, output_bulk_file, None)
+                locations = self.__locations__(batch_ids)
+                fast5_Index.__write_bulk__(self.__iter_reads__(locations),
+                    os.path.join(output, os.path.basename(batch_name)), len(locations))
         else:
             raise RuntimeError('[ERROR] Raw fast5 batch extension {} not supported.'.format(batch_ext))
 
-    def raw(self, ID):
-        pass
+    # open fast5 handle of located read through the cache
+    def __handle__(self, batch, member, offset, size):
+        batch_file = os.path.join(os.path.dirname(self.index_file), batch)
+        if member is None or batch.endswith('.fast5'):
+            return self.cache.get(batch_file, lambda : h5py.File(batch_file, 'r'))
+        if not size:
+            def members():
+                with tarfile.open(batch_file) as fp_tar:
+                    return {os.path.normpath(m.name):(m.offset_data, m.size) for m in fp_tar if m.isfile()}
+            tar_members = self.cache.get((batch_file, None), members)
+            offset, size = tar_members[member]
+        return self.cache.get((batch_file, member), lambda : fast5_Index.__open__(batch_file, (offset, size)))
+
+    # raw signal and channel scaling of read, optionally in pA
+    def __read_raw__(self, location, scale=False):
+        batch, member, offset, size = location
+        f5 = self.__handle__(batch, member, offset, size)
+        if batch.endswith('.fast5') and member is not None:
+            raw_group = f5[member + '/Raw']
+            channel = f5[member + '/channel_id']
+        else:
+            raw_group = next(iter(f5['/Raw/Reads'].values()))
+            channel = f5['/UniqueGlobalKey/channel_id']
+        scaling = {key:float(channel.attrs[key]) for key in ['digitisation', 'offset', 'range', 'sampling_rate'] if key in channel.attrs}
+        signal = raw_group['Signal'][...]
+        if scale:
+            signal = (signal + scaling['offset']) * (scaling['range'] / scaling['digitisation'])
+        return signal, scaling
+
+    # iterate (ID, signal, scaling) of requested reads in order of their source batches
+    def iter_raw(self, IDs, scale=False):
+        if self.read_index is None:
+            raise RuntimeError("[Error] Raw signal access without index file provided.")
+        for batch, member, offset, size, ID in self.__locations__(IDs):
+            try:
+                signal, scaling = self.__read_raw__((batch, member, offset, size), scale=scale)
+            except Exception:
+                print('[ERROR] Could not read signal of {id} from {batch}.'.format(id=ID, batch=batch), file=sys.stderr)
+                continue
+            yield ID, signal, scaling
+
+    # raw signal as numpy array and scaling of single read
+    def raw(self, ID, scale=False):
+        for _, signal, scaling in self.iter_raw([ID], scale=scale):
+            return signal, scaling
+        raise KeyError(ID)
+
+    # raw signal and scaling of multiple reads as dict, IDs not found are omitted
+    def raw_many(self, IDs, scale=False):
+        return {ID:(signal, scaling) for ID, signal, scaling in self.iter_raw(IDs, scale=scale)}
+
+
+# manifest of indexed batches of a run, batches with unchanged size, mtime
+# and content digest keep their index fragment next to the batch
+class batch_manifest():
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.manifest_file = os.path.join(run_dir, 'reads.manifest')
+        self.entries = {}
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, 'r') as fp:
+                for line in fp:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry['batch']] = entry
+
+    # digest of size, first, middle and last MiB of a batch
+    def __digest__(batch_file, block_size=1 << 20):
+        size = os.path.getsize(batch_file)
+        h = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(batch_file, 'rb') as fp:
+            for offset in sorted(set([0, max(0, size // 2 - block_size // 2), max(0, size - block_size)])):
+                fp.seek(offset)
+                h.update(fp.read(block_size))
+        return h.hexdigest()
+
+    def __fragment__(batch):
+        return os.path.splitext(batch)[0] + '.fofn'
+
+    def __qc__(batch):
+        return os.path.splitext(batch)[0] + '.qc.hdf5'
+
+    def __path__(self, batch):
+        return os.path.join(self.run_dir, batch)
+
+    # batches of the run relative to the run directory
+    def batches(self):
+        reads_dir = os.path.join(self.run_dir, 'reads')
+        batches = [os.path.join('reads', f) for f in os.listdir(reads_dir) if f.endswith('.tar') or f.endswith('.fast5')]
+        # repacked bulk-fast5 replace the tar archive of the same name
+        return sorted([batch for batch in batches if not (batch.endswith('.tar') and os.path.splitext(batch)[0] + '.fast5' in batches)])
+
+    # check if fragment of batch is up to date, update entry of touched but unchanged batches
+    def __valid__(self, batch):
+        batch_file, fragment_file = self.__path__(batch), self.__path__(batch_manifest.__fragment__(batch))
+        if not os.path.isfile(fragment_file):
+            return False
+        stat = os.stat(batch_file)
+        entry = self.entries.get(batch)
+        # fragment written after the batch e.g. by storage_index_batch
+        if os.path.getmtime(fragment_file) >= stat.st_mtime:
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                self.__record__(batch)
+            return True
+        if entry is None:
+            return False
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return True
+        if entry['size'] == stat.st_size and entry['digest'] == batch_manifest.__digest__(batch_file):
+            entry['mtime'] = stat.st_mtime
+            return True
+        return False
+
+    def __record__(self, batch):
+        stat = os.stat(self.__path__(batch))
+        with open(self.__path__(batch_manifest.__fragment__(batch)), 'r') as fp:
+            n_reads = sum(1 for line in fp if line.strip())
+        self.entries[batch] = {'batch': batch, 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'digest': batch_manifest.__digest__(self.__path__(batch)),
+            'fragment': batch_manifest.__fragment__(batch), 'reads': n_reads}
+
+    # index new and changed batches, returns number of re-indexed batches
+    def update(self, processes=1, qc=False):
+        batches = self.batches()
+        n_indexed = 0
+        for batch in batches:
+            qc_file = self.__path__(batch_manifest.__qc__(batch))
+            if self.__valid__(batch) and (not qc or os.path.isfile(qc_file)):
+                continue
+            fragment_file = self.__path__(batch_manifest.__fragment__(batch))
+            with open(fragment_file + '.tmp', 'w') as fp:
+                for record in fast5_Index.index(self.__path__(batch), output_prefix='reads', processes=processes, tar_offsets=True, qc_output=qc_file if qc else None):
+                    print(record, file=fp)
+            os.replace(fragment_file + '.tmp', fragment_file)
+            self.__record__(batch)
+            n_indexed += 1
+        self.entries = {batch:self.entries[batch] for batch in batches}
+        with open(self.manifest_file + '.tmp', 'w') as fp:
+            for batch in batches:
+                print(json.dumps(self.entries[batch], sort_keys=True), file=fp)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+        return n_indexed
+
+    # repack tar archives of single reads into compressed bulk-fast5 batches
+    def repack(self, processes=1, compression='vbz', keep_tar=False):
+        tar_batches = [batch for batch in self.batches() if batch.endswith('.tar')]
+        tasks = [(self.__path__(batch), compression) for batch in tar_batches]
+        repacked = []
+        if processes > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(processes) as pool:
+                for tar_file, read_ids in pool.imap(fast5_Index.__repack__, tasks):
+                    repacked.append((tar_file, read_ids))
+        else:
+            repacked = [fast5_Index.__repack__(task) for task in tasks]
+        # archives without reads are left in place
+        kept = [(batch, r) for batch, r in zip(tar_batches, repacked) if r[1] is not None]
+        tar_batches, repacked = [batch for batch, _ in kept], [r for _, r in kept]
+        # write fragments of repacked batches and update the run index before removing archives
+        for batch, (tar_file, read_ids) in zip(tar_batches, repacked):
+            bulk_batch = os.path.splitext(batch)[0] + '.fast5'
+            fragment_file = self.__path__(batch_manifest.__fragment__(bulk_batch))
+            with open(fragment_file + '.tmp', 'w') as fp:
+                for read_id in read_ids:
+                    print('\t'.join([os.path.join(bulk_batch, 'read_' + read_id), read_id]), file=fp)
+            os.replace(fragment_file + '.tmp', fragment_file)
+            self.entries.pop(batch, None)
+            self.__record__(bulk_batch)
+        self.update(processes=processes)
+        self.merge()
+        for batch, (tar_file, read_ids) in zip(tar_batches, repacked):
+            if keep_tar:
+                tar_dir = os.path.join(self.run_dir, 'reads_tar')
+                os.makedirs(tar_dir, exist_ok=True)
+                os.replace(tar_file, os.path.join(tar_dir, os.path.basename(tar_file)))
+            else:
+                os.remove(tar_file)
+        return [(batch, len(read_ids)) for batch, (tar_file, read_ids) in zip(tar_batches, repacked)]
+
+    # index records of all batches with tar member offsets
+    def records(self):
+        for batch in sorted(self.entries.keys()):
+            with open(self.__path__(self.entries[batch]['fragment']), 'r') as fp:
+                for line in fp:
+                    if line.strip():
+                        yield line.rstrip('\n').split('\t')
+
+    # write text and binary index of the run from all fragments
+    def merge(self, fofn=None, idx=None):
+        fofn = fofn or os.path.join(self.run_dir, 'reads.fofn')
+        idx = idx or os.path.join(self.run_dir, 'reads.idx')
+        with open(fofn + '.tmp', 'w') as fp:
+            for record in self.records():
+                print('\t'.join(record[:2]), file=fp)
+        os.replace(fofn + '.tmp', fofn)
+        binary_index.write(idx, self.records())
+
+    # concatenate signal metrics of all batches
+    def merge_qc(self, output=None):
+        output = output or os.path.join(self.run_dir, 'reads.qc.hdf5')
+        columns = {column:[] for column, _ in fast5_Index.qc_columns}
+        for batch in sorted(self.entries.keys()):
+            qc_file = self.__path__(batch_manifest.__qc__(batch))
+            if not os.path.isfile(qc_file):
+                print("[WARNING] No signal metrics for {batch}".format(batch=batch), file=sys.stderr)
+                continue
+            with h5py.File(qc_file, 'r') as f5:
+                for column in columns:
+                    columns[column].append(f5[column][...])
+        fast5_Index.__write_QC__(output, {column:np.concatenate(values) if values else [] for column, values in columns.items()})
+
+
+
+
+# node local cache of extracted batches shared by jobs on the same node
+#   <cache_dir>/<key>/          extracted files of one batch and format
+#   <cache_dir>/<key>.lock      lock held during extraction and linking
+#   <cache_dir>/cache.log       hit and miss statistics
+class extraction_cache():
+    def __init__(self, cache_dir, max_size=100):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1024**3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # key of run, batch, format and requested read IDs
+    def __key__(self, input, format, index_file=None):
+        h = hashlib.blake2b(digest_size=16)
+        run_dir = os.path.dirname(index_file) if index_file else os.path.dirname(os.path.dirname(input))
+        stat = os.stat(input)
+        h.update('\t'.join([os.path.abspath(run_dir), os.path.basename(input), format, str(stat.st_size), str(stat.st_mtime)]).encode())
+        if input.endswith('.txt'):
+            with open(input, 'r') as fp:
+                h.update('\n'.join(sorted(id.strip() for id in fp if id.strip())).encode())
+        return h.hexdigest()
+
+    def __size__(entry):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry) for f in files)
+
+    def __log__(self, status, key, size):
+        with open(os.path.join(self.cache_dir, 'cache.log'), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            print('\t'.join([str(int(time.time())), status, key, str(size)]), file=fp)
+        print('[INFO] Extraction cache {status} for {key} ({size} bytes)'.format(status=status, key=key, size=size), file=sys.stderr)
+
+    # hardlink cached files into output, copy across file systems
+    # evicted entries must not affect running jobs, therefore no symbolic links
+    def __link__(entry, output):
+        for root, _, files in os.walk(entry):
+            out_dir = os.path.join(output, os.path.relpath(root, entry))
+            os.makedirs(out_dir, exist_ok=True)
+            for f in files:
+                src, dst = os.path.join(root, f), os.path.join(out_dir, f)
+                try:
+                    os.link(src, dst)
+                except OSError as e:
+                    if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                        raise
+                    shutil.copyfile(src, dst)
+
+    # remove least recently used entries exceeding the size limit
+    def __evict__(self, keep):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if os.path.isdir(entry) and not key.endswith('.tmp') and key != keep:
+                entries.append((os.path.getmtime(entry), entry, extraction_cache.__size__(entry)))
+        total = sum(size for _, _, size in entries) + extraction_cache.__size__(os.path.join(self.cache_dir, keep))
+        for _, entry, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            with open(entry + '.lock', 'a') as fp_lock:
+                try:
+                    fcntl.flock(fp_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # entry in use by concurrent job
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+            self.__log__('evict', os.path.basename(entry), size)
+
+    # extract batch through the cache, concurrent jobs wait for a single extraction
+    def extract(self, f5_index, input, output, format):
+        key = self.__key__(input, format, f5_index.index_file)
+        entry = os.path.join(self.cache_dir, key)
+        with open(entry + '.lock', 'a') as fp_lock:
+            fcntl.flock(fp_lock, fcntl.LOCK_EX)
+            if os.path.isdir(entry):
+                os.utime(entry)
+                extraction_cache.__link__(entry, output)
+                self.__log__('hit', key, extraction_cache.__size__(entry))
+                return
+            shutil.rmtree(entry + '.tmp', ignore_errors=True)
+            f5_index.extract(input, entry + '.tmp', format=format)
+            os.rename(entry + '.tmp', entry)
+            extraction_cache.__link__(entry, output)
+            self.__log__('miss', key, extraction_cache.__size__(entry))
+        self.__evict__(keep=key)
+
+
 
 
 class main():
@@ -212,6 +886,8 @@ class main():
         usage='''storage_fast5Index.py <command> [<args>]
 Available commands are:
    index        Index batch(es) of bulk-fast5 or tar archived single fast5
+   update       Index new or changed batches of a run and merge the run index
+   repack       Convert tar archived single fast5 of a run into compressed bulk-fast5
    extract      Extract single reads from indexed sequencing run
 ''')
         parser.add_argument('command', help='Subcommand to run')
@@ -227,21 +903,53 @@ Available commands are:
         parser.add_argument("input", help="Input batch or directory of batches")
         parser.add_argument("--recursive", action='store_true', help="Recursively scan input")
         parser.add_argument("--out_prefix", default="", help="Prefix for file paths in output")
-        parser.add_argument("--tmp_prefix", default=None, help="Prefix for temporary data")
+        parser.add_argument("--tmp_prefix", default=None, help="Unused, tar archives are indexed in memory")
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--tar_offsets", action='store_true', help="Append data offset and size of tar members")
+        parser.add_argument("--qc", default=None, help="Write signal metrics of indexed reads to hdf5 file")
         args = parser.parse_args(argv)
-        for record in fast5_Index.index(args.input, recursive=args.recursive, output_prefix=args.out_prefix, tmp_prefix=args.tmp_prefix):
+        for record in fast5_Index.index(args.input, recursive=args.recursive, output_prefix=args.out_prefix, processes=args.processes, tar_offsets=args.tar_offsets, qc_output=args.qc):
             print(record)
 
+    def update(self, argv):
+        parser = argparse.ArgumentParser(description="Incremental run index")
+        parser.add_argument("run", help="Run directory with reads subfolder")
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--qc", action='store_true', help="Collect signal metrics and merge into reads.qc.hdf5")
+        args = parser.parse_args(argv)
+        manifest = batch_manifest(args.run)
+        n_indexed = manifest.update(processes=args.processes, qc=args.qc)
+        manifest.merge()
+        if args.qc:
+            manifest.merge_qc()
+        print("[INFO] Indexed {n} of {total} batches".format(n=n_indexed, total=len(manifest.entries)), file=sys.stderr)
+
+    def repack(self, argv):
+        parser = argparse.ArgumentParser(description="Repack tar archives into bulk-fast5")
+        parser.add_argument("run", help="Run directory with reads subfolder")
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--compression", default='vbz', choices=['vbz', 'gzip'], help="Compression of raw signal datasets")
+        parser.add_argument("--keep_tar", action='store_true', help="Move tar archives to reads_tar instead of removing them")
+        args = parser.parse_args(argv)
+        manifest = batch_manifest(args.run)
+        for batch, n_reads in manifest.repack(processes=args.processes, compression=args.compression, keep_tar=args.keep_tar):
+            print('\t'.join([batch, str(n_reads)]))
+
     def extract(self, argv):
         parser = argparse.ArgumentParser(description="Fast5 extraction")
         parser.add_argument("batch", help="Input batch")
         parser.add_argument("output", help="Output directory")
         parser.add_argument("--index", default=None, help="Read index")
         parser.add_argument("--output_format", default='single', choices=['single', 'bulk', 'lazy'], help="Output as single, bulk or with minimal conversion overhead")
-        parser.add_argument("--tmp_prefix", default=None, help="Prefix for temporary data")
+        parser.add_argument("--tmp_prefix", default=None, help="Unused, batches are extracted without temporary data")
+        parser.add_argument("--cache_dir", default=None, help="Node local cache of extracted batches")
+        parser.add_argument("--cache_size", type=float, default=100, help="Cache size limit in GB")
         args = parser.parse_args(argv)
-        f5_index = fast5_Index(args.index, tmp_prefix=args.tmp_prefix)
-        f5_index.extract(args.batch, args.output, format=args.output_format)
+        f5_index = fast5_Index(args.index)
+        if args.cache_dir:
+            extraction_cache(args.cache_dir, args.cache_size).extract(f5_index, args.batch, args.output, args.output_format)
+        else:
+            f5_index.extract(args.batch, args.output, format=args.output_format)
 
 
 
@@ -34,12 +34,12 @@
 # imports
 import os, sys, glob, re, enum
 import time, datetime
-import argparse
+import argparse, json, shlex, subprocess
 import h5py, tarfile
-import threading
+import threading, signal
 import queue
-from collections import deque
-from multiprocessing import Process, Queue
+from collections import deque, OrderedDict
+from multiprocessing import Process, Queue, Pool
 from watchdog.events import RegexMatchingEventHandler
 
 
@@ -104,40 +104,55 @@ class fs_event_handler(RegexMatchingEventHandler):
 
 
 
-# thread safe file queue
+# thread safe file queue, ordered by time of last event
 class delay_queue(object):
     def __init__(self):
-        self.__keys = {}
-        self.__values = deque()
-        self.__lock = threading.Lock()
+        self.__values = OrderedDict()
+        self.__condition = threading.Condition()
 
     def __len__(self):
-        with self.__lock:
+        with self.__condition:
             return len(self.__values)
 
     def put(self, obj):
-        self.delay(obj, update=False)
+        self.delay(obj)
 
-    def delay(self, obj, update=True):
-        with self.__lock:
-            if update and obj in self.__keys:
-                self.__values.remove(obj)
-            self.__keys[obj] = time.time()
-            self.__values.append(obj)
+    def delay(self, obj):
+        with self.__condition:
+            self.__values[obj] = time.time()
+            self.__values.move_to_end(obj)
+            self.__condition.notify_all()
 
     def delete(self, obj):
-        with self.__lock:
-            if obj in self.__keys:
-                self.__values.remove(obj)
-                del self.__keys[obj]
+        with self.__condition:
+            self.__values.pop(obj, None)
 
     def pop(self, t=0):
         t_now = time.time()
-        with self.__lock:
-            while len(self.__values) and t_now - self.__keys[obj] > t:
-                obj = self.__values.popleft()
-                del self.__keys[obj]
-                yield obj
+        expired = []
+        with self.__condition:
+            for obj, t_obj in self.__values.items():
+                if t_now - t_obj <= t:
+                    break
+                expired.append(obj)
+            for obj in expired:
+                del self.__values[obj]
+        return expired
+
+    # block until the oldest entry is older than t or timeout
+    def wait(self, t=0, timeout=None):
+        t_end = time.time() + timeout if timeout is not None else None
+        with self.__condition:
+            while True:
+                t_now = time.time()
+                t_wait = next(iter(self.__values.values())) + t - t_now if len(self.__values) else None
+                if t_wait is not None and t_wait < 0:
+                    return True
+                if t_end is not None:
+                    if t_end <= t_now:
+                        return False
+                    t_wait = min(t_wait, t_end - t_now) if t_wait is not None else t_end - t_now
+                self.__condition.wait(t_wait)
 
 
 
@@ -175,20 +190,123 @@ class fs_watchdog():
     def files(self, t=0):
         return self.fs_queue.pop(t)
 
+    def wait(self, t=0, timeout=None):
+        return self.fs_queue.wait(t, timeout=timeout)
+
+
+
+
+# run pipeline targets of closed batches during the import
+# invocations are serialized, shared prerequisites like run indices and reference
+# indices are written by one Snakemake instance holding the working directory lock
+class live_pipeline():
+    def __init__(self, runname, targets, merge_targets=[], workdir='.', snakefile=None, snakemake='snakemake', snakemake_args='',
+                 jobs=2, batches_per_job=4, merge_interval=3600):
+        self.runname = runname
+        self.targets = targets
+        self.merge_targets = merge_targets
+        self.workdir = os.path.abspath(workdir)
+        self.snakefile = snakefile or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Snakefile')
+        self.snakemake = snakemake
+        self.snakemake_args = snakemake_args
+        self.jobs = jobs
+        self.batches_per_job = batches_per_job
+        self.merge_interval = merge_interval
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.active = False
+        self.n_done = 0
+        self.n_merged = 0
+        self.thread = None
+
+    def __invoke__(self, targets):
+        cmd = [self.snakemake, '--snakefile', self.snakefile, '--directory', self.workdir, '--jobs', str(self.jobs)] + shlex.split(self.snakemake_args) + targets
+        t0 = time.time()
+        try:
+            ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        except OSError as ex:
+            logger.log("Could not run {snakemake}: {ex}".format(snakemake=self.snakemake, ex=str(ex)), logger.log_type.Error)
+            return False
+        if ret.returncode != 0:
+            logger.log("Pipeline failed for {targets}:\n{output}".format(targets=' '.join(targets), output='\n'.join(ret.stdout.splitlines()[-20:])), logger.log_type.Error)
+            return False
+        logger.log("Pipeline finished {n} targets in {t:.0f} s".format(n=len(targets), t=time.time() - t0))
+        return True
+
+    # process pending batches, multiple batches are combined if the pipeline falls behind
+    # run level targets are refreshed in between batch invocations
+    def __worker__(self):
+        t_last = time.time()
+        while True:
+            with self.condition:
+                while self.active and not len(self.pending) and (self.n_done == self.n_merged or time.time() - t_last < self.merge_interval):
+                    self.condition.wait(max(1.0, self.merge_interval - (time.time() - t_last)))
+                if not self.active and not len(self.pending):
+                    return
+                merge = self.n_done > self.n_merged and time.time() - t_last >= self.merge_interval
+                batches = [] if merge else [self.pending.popleft() for i in range(min(len(self.pending), self.batches_per_job))]
+            if merge:
+                n_done = self.n_done
+                self.__merge__()
+                t_last = time.time()
+                self.n_merged = n_done
+            else:
+                self.__invoke__([target.format(runname=self.runname, batch=batch) for batch in batches for target in self.targets])
+                with self.condition:
+                    self.n_done += len(batches)
+
+    def __merge__(self):
+        if len(self.merge_targets):
+            self.__invoke__([target.format(runname=self.runname) for target in self.merge_targets])
+
+    def start(self):
+        self.active = True
+        self.thread = threading.Thread(target=self.__worker__)
+        self.thread.start()
+        logger.log("Started live pipeline with {jobs} parallel jobs".format(jobs=self.jobs))
+
+    def put(self, batch):
+        with self.condition:
+            self.pending.append(batch)
+            if len(self.pending) > self.batches_per_job:
+                logger.log("Live pipeline is {n} batches behind".format(n=len(self.pending)), logger.log_type.Warning)
+            self.condition.notify_all()
+
+    # finish pending batches and refresh run level targets
+    def stop(self):
+        with self.condition:
+            self.active = False
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+        self.thread = None
+        if self.n_done > self.n_merged:
+            self.__merge__()
+            self.n_merged = self.n_done
+        logger.log("Stopped live pipeline")
+
 
 
 
 # package files to batch tar archives
 class packager():
-    def __init__(self, src_dirs, dst_dir, recursive=True, ignore_existing=False, regexes=['.*'], batch_size=4000):
+    # live are the keyword arguments of a live_pipeline, the pipeline is created in the packager process
+    def __init__(self, src_dirs, dst_dir, recursive=True, ignore_existing=False, regexes=['.*'], batch_size=4000, writers=1, verify=False, index=False, live=None, file_queue=None):
         self.src_dirs = src_dirs
         self.dst_dir = dst_dir
         self.recursive = recursive
         self.ignore_existing = ignore_existing
         self.regexes = regexes
         self.batch_size = batch_size
-        self.file_queue = Queue()
+        self.writers = writers
+        self.verify = verify
+        self.index = index
+        self.live = live
+        self.journal_file = os.path.join(dst_dir, 'import.journal')
+        self.file_queue = file_queue if file_queue is not None else Queue()
         self.__packager = None
+        self.__args = dict(src_dirs=src_dirs, dst_dir=dst_dir, recursive=recursive, ignore_existing=ignore_existing, regexes=regexes,
+            batch_size=batch_size, writers=writers, verify=verify, index=index, live=live)
 
     def __get_src__(self):
         pattern = '|'.join([r for r in self.regexes])
@@ -201,31 +319,99 @@ class packager():
         return {os.path.basename(f):f for f in existing}
 
     def __get_tar__(self):
-        tarfiles = [os.path.abspath(os.path.join(self.dst_dir, f)) for f in os.listdir(self.dst_dir) if re.match("[0-9]*.tar", f)]
+        tarfiles = [os.path.abspath(os.path.join(self.dst_dir, f)) for f in os.listdir(self.dst_dir) if re.match("^[0-9]+\.tar$", f)]
         return tarfiles
 
+    # journal of closed archives and their members, last entry of an archive is valid
+    def __read_journal__(self):
+        journal = {}
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file, 'r') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # incomplete entry of interrupted import
+                        continue
+                    journal[entry['archive']] = entry
+        return journal
+
+    def __journal_entry__(tf, members):
+        return {'archive': os.path.basename(tf), 'batch': int(os.path.basename(tf)[:-4]),
+                'size': os.path.getsize(tf), 'members': members}
+
+    def __write_journal__(self, entries, mode='a'):
+        with open(self.journal_file + ('.tmp' if mode == 'w' else ''), mode) as fp:
+            for entry in entries:
+                print(json.dumps(entry), file=fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        if mode == 'w':
+            os.replace(self.journal_file + '.tmp', self.journal_file)
+
+    # archived files from journal, archives without valid journal entry are scanned
     def __get_dst__(self):
         tarfiles = self.__get_tar__()
+        journal = {} if self.verify else self.__read_journal__()
         existing = {}
-        for tf in tarfiles:
-            with tarfile.open(tf) as tar:
-                tar_members = tar.getmembers()
-                existing.update({tar_member.name:os.path.join(tf, tar_member.name) for tar_member in tar_members})
+        scanned = []
+        for tf in sorted(tarfiles, key=lambda x : int(os.path.basename(x)[:-4])):
+            entry = journal.get(os.path.basename(tf))
+            if entry is None or entry['size'] != os.path.getsize(tf):
+                with tarfile.open(tf) as tar:
+                    entry = packager.__journal_entry__(tf, tar.getnames())
+                scanned.append(entry)
+            existing.update({member:os.path.join(tf, member) for member in entry['members']})
+        if self.verify:
+            self.__write_journal__(scanned, mode='w')
+        elif len(scanned):
+            self.__write_journal__(scanned)
+        logger.log("Read {journal} archives from journal, scanned {scanned} archives".format(journal=len(tarfiles) - len(scanned), scanned=len(scanned)))
         return existing
 
-    def __write_tar__(self, fname, batch):
-        n = 0
-        with tarfile.open(fname, 'w') as fp:
+    # read ID of single read fast5
+    def __get_read_id__(f5_file):
+        try:
+            with h5py.File(f5_file, 'r') as f5:
+                read_id = next(iter(f5['/Raw/Reads'].values())).attrs['read_id']
+                return read_id.decode('utf-8') if isinstance(read_id, bytes) else str(read_id)
+        except Exception:
+            logger.log("Could not read ID of {f5}, skip file for indexing".format(f5=f5_file), logger.log_type.Error)
+            return None
+
+    # write batch into temporary archive, run in writer processes
+    # with index, read IDs and member offsets are written to a temporary batch index
+    def __write_tar__(task):
+        fname, batch, index = task
+        t0 = time.time()
+        members, size = [], 0
+        read_ids = {}
+        with tarfile.open(fname + '.tmp', 'w') as fp:
             for f in batch:
                 if os.path.isfile(f):
+                    if index:
+                        read_ids[os.path.basename(f)] = packager.__get_read_id__(f)
                     fp.add(f, arcname=os.path.basename(f))
-                    n += 1
-        return n
+                    members.append(os.path.basename(f))
+                    size += os.path.getsize(f)
+        if index:
+            batch_relative = os.path.join(os.path.basename(os.path.dirname(fname)), os.path.basename(fname))
+            with tarfile.open(fname + '.tmp', 'r:') as fp, open(fname[:-4] + '.fofn.tmp', 'w') as fp_index:
+                for tar_member in fp:
+                    if read_ids.get(tar_member.name):
+                        print('\t'.join([os.path.join(batch_relative, tar_member.name), read_ids[tar_member.name],
+                            str(tar_member.offset_data), str(tar_member.size)]), file=fp_index)
+        return os.getpid(), members, size, time.time() - t0
+
+    # interrupts are handled by the coordinator draining the writers
+    def __init_writer__():
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     def start(self):
         if self.__packager:
             self.__packager.join()
-        self.__packager = Process(target=self.__run__, )
+        # only picklable arguments are passed to the packager process
+        self.__packager = Process(target=packager.__process__, args=(self.__args, self.file_queue))
         self.__packager.start()
 
     def stop(self):
@@ -236,8 +422,16 @@ class packager():
     def put(self, src_file):
         self.file_queue.put(os.path.abspath(src_file))
 
+    def __process__(args, file_queue):
+        packager(file_queue=file_queue, **args).__run__()
+
     def __run__(self):
+        live = live_pipeline(**self.live) if self.live else None
         try:
+            # remove archives of interrupted writers, their files are archived again
+            for f in os.listdir(self.dst_dir):
+                if re.match("^[0-9]+\.(tar|fofn)\.tmp$", f):
+                    os.remove(os.path.join(self.dst_dir, f))
             # get existing src/dest files
             logger.log("Inspect existing files and archives")
             dst_files = self.__get_dst__()
@@ -272,12 +466,42 @@ class packager():
                     logger.log("Exiting with files in archive not found in source directory. Re-run with --ignore_existing to archive anyway")
                     return
             processing_queue.extend(sorted([src_files[f] for f in to_archive]))
+        except KeyboardInterrupt:
+            logger.log("Archive worker shutdown on user request")
+            return
+        # batch numbers are assigned on dispatch, archives are renamed in order of their number
+        in_flight = OrderedDict()
+        writer_stats = {}
+        def dispatch(batch):
+            nonlocal batch_count
+            batch_name = os.path.join(self.dst_dir, str(batch_count) + '.tar')
+            in_flight[batch_name] = pool.apply_async(packager.__write_tar__, ((batch_name, batch, self.index),))
+            batch_count += 1
+        def commit(block=False):
+            while len(in_flight) and (block or next(iter(in_flight.values())).ready()):
+                batch_name, result = in_flight.popitem(last=False)
+                pid, members, size, t = result.get()
+                n = len(members)
+                os.replace(batch_name + '.tmp', batch_name)
+                if self.index:
+                    os.replace(batch_name[:-4] + '.fofn.tmp', batch_name[:-4] + '.fofn')
+                if live:
+                    live.put(os.path.basename(batch_name)[:-4])
+                self.__write_journal__([packager.__journal_entry__(batch_name, members)])
+                stats = writer_stats.setdefault(pid, [0, 0, 0.0])
+                stats[0] += n; stats[1] += size; stats[2] += t
+                logger.log("Archived {count} reads in {archive} ({rate:.1f} MB/s, writer {pid})".format(count=n, archive=batch_name, rate=size / max(t, 1e-6) / 1e6, pid=pid))
+                block = False
+        pool = Pool(self.writers, initializer=packager.__init_writer__)
+        if live:
+            live.start()
+        try:
             # enter main archive loop
             while active:
                 # get file names from queue
                 try:
                     try:
-                        f = self.file_queue.get(block=False)
+                        f = self.file_queue.get(timeout=1)
                         while f:
                             processing_queue.append(f)
                             f = self.file_queue.get(block=False)
@@ -287,29 +511,29 @@ class packager():
                         pass
                     # archive files in batches
                     while len(processing_queue) >= self.batch_size:
-                        batch = [processing_queue.popleft() for i in range(self.batch_size)]
-                        batch_name = os.path.join(self.dst_dir, str(batch_count) + '.tar')
-                        try:
-                            n = self.__write_tar__(batch_name, batch)
-                        except KeyboardInterrupt:
-                            logger.log("Archiving of {archive} interrupted. The file is likely damaged".format(archive=batch_name))
-                            raise
-                        batch_count += 1
-                        logger.log("Archived {count} reads in {archive}".format(count=n, archive=batch_name))
+                        # limit number of queued batches
+                        if len(in_flight) >= 2 * self.writers:
+                            commit(block=True)
+                        dispatch([processing_queue.popleft() for i in range(self.batch_size)])
+                    commit()
                 except KeyboardInterrupt:
                     # leave controlled shutdown to master process
                     break
-            # archive remaining reads
+            # archive remaining reads and drain writers
             while len(processing_queue) > 0:
-                batch =  [processing_queue.popleft() for i in range(min(len(processing_queue), self.batch_size))]
-                batch_name = os.path.join(self.dst_dir, str(batch_count) + '.tar')
-                if len(batch) > 0:
-                    n = self.__write_tar__(batch_name, batch)
-                    logger.log("Archived {count} reads in {archive}".format(count=n, archive=batch_name))
-                    batch_count += 1
-        except KeyboardInterrupt:
-            logger.log("Archive worker shutdown on user request")
-            return
+                dispatch([processing_queue.popleft() for i in range(min(len(processing_queue), self.batch_size))])
+            while len(in_flight):
+                try:
+                    commit(block=True)
+                except KeyboardInterrupt:
+                    logger.log("Waiting for {n} archives in progress".format(n=len(in_flight)))
+        finally:
+            pool.close()
+            pool.join()
+            if live:
+                live.stop()
+        for pid, (n, size, t) in sorted(writer_stats.items()):
+            logger.log("Writer {pid} archived {count} reads with {size:.1f} MB in {t:.1f} s ({rate:.1f} MB/s)".format(pid=pid, count=n, size=size / 1e6, t=t, rate=size / max(t, 1e-6) / 1e6))
 
 
 
@@ -322,11 +546,22 @@ if __name__ == '__main__':
     parser.add_argument("input", nargs="+", help="Import directories")
     parser.add_argument("-f", "--filter", nargs="+", default=[".*\.fast5"], help="File filter regex")
     parser.add_argument("-b", "--batch_size", type=int, default=4000, help="Number of files to put into one archive")
+    parser.add_argument("-w", "--writers", type=int, default=1, help="Number of parallel archive writers")
     parser.add_argument("--recursive", action="store_true", help="Recursivly scan import directory")
     parser.add_argument("--watch", action="store_true", help="Watch input for incoming files")
     parser.add_argument("-l", "--log", default=None, help="Log file")
     parser.add_argument("--grace_period", type=int, default=60, help="Time in seconds before treating a file as final")
     parser.add_argument("--ignore_existing", action="store_true", help="Proceed with files found in archive but not in import location")
+    parser.add_argument("--verify", action="store_true", help="Scan all archives instead of reading the import journal")
+    parser.add_argument("--index", action="store_true", help="Write read index of each archive next to the batch")
+    parser.add_argument("--live_targets", nargs="+", default=[], help="Pipeline targets per closed batch with {runname} and {batch} placeholders")
+    parser.add_argument("--live_merge_targets", nargs="+", default=[], help="Run level pipeline targets with {runname} placeholder")
+    parser.add_argument("--live_merge_interval", type=int, default=3600, help="Time in seconds between updates of run level targets")
+    parser.add_argument("--live_workdir", default='.', help="Processing directory of the live pipeline")
+    parser.add_argument("--live_jobs", type=int, default=2, help="Number of parallel jobs of the live pipeline")
+    parser.add_argument("--live_batches", type=int, default=4, help="Maximum number of batches per pipeline invocation")
+    parser.add_argument("--snakemake", default="snakemake", help="Snakemake executable")
+    parser.add_argument("--snakemake_args", default="", help="Additional Snakemake arguments, e.g. cluster configuration")
     args = parser.parse_args()
     # start logging
     logger.init(file=args.log, log_types=[logger.log_type.Error, logger.log_type.Info, logger.log_type.Debug] )
@@ -349,8 +584,14 @@ if __name__ == '__main__':
     if len(input_dirs) == 0:
         logger.log("No readable input directory specified", logger.log_type.Error)
         exit(-1)
+    # create live pipeline
+    live = None
+    if args.live_targets:
+        live = dict(runname=os.path.basename(os.path.dirname(dir_out)), targets=args.live_targets, merge_targets=args.live_merge_targets,
+            workdir=args.live_workdir, snakemake=args.snakemake, snakemake_args=args.snakemake_args,
+            jobs=args.live_jobs, batches_per_job=args.live_batches, merge_interval=args.live_merge_interval)
     # create packager
-    pkgr = packager(input_dirs, dir_out, recursive=args.recursive, ignore_existing=args.ignore_existing, regexes=args.filter, batch_size=args.batch_size)
+    pkgr = packager(input_dirs, dir_out, recursive=args.recursive, ignore_existing=args.ignore_existing, regexes=args.filter, batch_size=args.batch_size, writers=args.writers, verify=args.verify, index=args.index, live=live)
     pkgr.start()
     # create fs watchdogs
     if args.watch:
@@ -361,8 +602,10 @@ if __name__ == '__main__':
         logger.log("Started file system observer, press CTRL + C to abort")
         try:
             while True:
-                for f in wtchdg.files(t=args.grace_period):
-                    pkgr.put(f)
+                # wake up at least every second to handle keyboard interrupts on all platforms
+                if wtchdg.wait(t=args.grace_period, timeout=1.0):
+                    for f in wtchdg.files(t=args.grace_period):
+                        pkgr.put(f)
         except KeyboardInterrupt:
             logger.log("Abort by user, trying to shutdown properly")
             wtchdg.stop()
@@ -0,0 +1,101 @@
+# \TEST\-------------------------------------------------------------------------
+#
+#  CONTENTS      : Snakemake nanopore data pipeline
+#
+#  DESCRIPTION   : test guppy basecall server dispatcher
+#
+#  RESTRICTIONS  : none
+#
+#  REQUIRES      : none
+#
+# ---------------------------------------------------------------------------------
+# Copyright (c) 2018-2021, Pay Giesselmann, Max Planck Institute for Molecular Genetics
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Written by Pay Giesselmann
+# ---------------------------------------------------------------------------------
+import os, sys, json
+import subprocess
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rules', 'utils'))
+from basecalling_guppy_server import guppy_server_dispatcher
+
+
+
+
+# leases in temporary state file, processes of this test act as jobs
+class test_guppy_server_dispatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmp_dir.name, 'guppy_server.leases')
+        self.dispatcher = guppy_server_dispatcher(self.state_file)
+        self.servers = ['5555', 'localhost:5556']
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    # pid of terminated child process
+    def __dead_pid__(self):
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        return proc.pid
+
+    def test_least_weight(self):
+        l1 = self.dispatcher.lease(self.servers, weight=100, pid=os.getpid())
+        l2 = self.dispatcher.lease(self.servers, weight=10, pid=os.getpid())
+        l3 = self.dispatcher.lease(self.servers, weight=10, pid=os.getpid())
+        self.assertEqual(l1['server'], '5555')
+        self.assertEqual(l2['server'], 'localhost:5556')
+        self.assertEqual(l3['server'], 'localhost:5556')
+        self.assertEqual(len(self.dispatcher.status()), 3)
+
+    def test_release(self):
+        l1 = self.dispatcher.lease(self.servers, weight=100, pid=os.getpid())
+        l2 = self.dispatcher.lease(self.servers, weight=10, pid=os.getpid())
+        self.dispatcher.release(l1['id'])
+        self.assertEqual([lease['id'] for lease in self.dispatcher.status()], [l2['id']])
+        l3 = self.dispatcher.lease(self.servers, weight=10, pid=os.getpid())
+        self.assertEqual(l3['server'], '5555')
+
+    def test_expire_dead_pid(self):
+        l1 = self.dispatcher.lease(self.servers, weight=100, pid=self.__dead_pid__())
+        self.assertEqual(self.dispatcher.status(), [])
+        l2 = self.dispatcher.lease(self.servers, weight=10, pid=os.getpid())
+        self.assertEqual(l2['server'], l1['server'])
+
+    def test_expire_timeout(self):
+        l1 = self.dispatcher.lease(self.servers, weight=100, pid=os.getpid())
+        with open(self.state_file, 'r') as fp:
+            leases = json.load(fp)
+        leases[0]['time'] -= 2 * self.dispatcher.timeout
+        with open(self.state_file, 'w') as fp:
+            json.dump(leases, fp)
+        self.assertEqual(self.dispatcher.status(), [])
+        l2 = self.dispatcher.lease(self.servers, weight=10, pid=os.getpid())
+        self.assertEqual(l2['server'], l1['server'])
+
+
+
+
+# main function
+if __name__ == '__main__':
+    unittest.main()